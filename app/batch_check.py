@@ -0,0 +1,236 @@
+"""Apply the QC checks used by the app to a batch of lab templates, without the
+Streamlit interface. Run from the root of the repository, e.g.
+
+    python app/batch_check.py "data/eurofins_data_*_q*_v*.xlsx" --lab Eurofins
+
+A JSON report is written for each template, together with a CSV summary listing
+the outcome of every rule for every file. Reports are named from each template's
+path relative to the folder shared by all templates (with sub-folders joined by
+'__') and list the Excel row numbers of problem rows.
+"""
+
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import qc
+
+# Index labels from 'qc.parse_data_template' plus this offset give row numbers in
+# the Excel sheet (the first data row, row 4, has label 2)
+EXCEL_ROW_OFFSET = 2
+
+# Reference data for worker processes, set once per process by '_init_worker'
+_cols = None
+_stations = None
+
+
+def _init_worker(cols, stations):
+    """Store reference data in each worker process, so it is only sent once."""
+    global _cols, _stations
+    _cols = cols
+    _stations = stations
+
+
+def check_template(file_path, sheet_name="results"):
+    """Read a template and apply all QC rules. Must be called in a process set up
+    by '_init_worker'.
+
+    Args:
+        file_path:  Str. Path to Excel template
+        sheet_name: Str. Name of sheet to read
+
+    Returns:
+        Dict. JSON-serialisable report for the template.
+    """
+    report = {"file": file_path, "n_rows": None, "results": []}
+    try:
+        df, missing_cols = qc.parse_data_template(
+            file_path, _cols, sheet_name=sheet_name
+        )
+    except Exception as e:
+        missing_cols = []
+        df = None
+        report["results"].append(
+            {
+                "rule": "read",
+                "title": "Reading template",
+                "severity": "error",
+                "message": f"Could not read template: {e}",
+                "details": [],
+                "tables": [],
+                "excel_rows": [],
+            }
+        )
+        return report
+
+    if len(missing_cols) > 0:
+        report["results"].append(
+            {
+                "rule": "read",
+                "title": "Reading template",
+                "severity": "error",
+                "message": "The data file is missing some required parameters.",
+                "details": [f"Column {col} is missing." for col in missing_cols],
+                "tables": [],
+                "excel_rows": [],
+            }
+        )
+        return report
+
+    report["n_rows"] = len(df)
+    for result in qc.run_checks(df, _stations):
+        report["results"].append(
+            {
+                "rule": result.rule,
+                "title": result.title,
+                "severity": result.severity,
+                "message": result.message,
+                "details": result.details,
+                "tables": [
+                    {
+                        "caption": caption,
+                        "data": json.loads(
+                            table.to_json(orient="records", date_format="iso")
+                        ),
+                    }
+                    for caption, table in result.tables
+                ],
+                "excel_rows": [int(idx) + EXCEL_ROW_OFFSET for idx in result.rows],
+            }
+        )
+
+    return report
+
+
+def get_report_names(file_paths):
+    """Name the report for each template from its path relative to the folder
+    shared by all templates, so files with the same name in different sub-folders
+    do not overwrite each other's reports.
+
+    Args:
+        file_paths: List of str. Paths to Excel templates
+
+    Returns:
+        List of str. File name of the JSON report for each template.
+    """
+    abs_paths = [os.path.abspath(path) for path in file_paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in abs_paths])
+    names = [
+        os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, "__")
+        + "_qc.json"
+        for path in abs_paths
+    ]
+    dup_names = sorted({name for name in names if names.count(name) > 1})
+    assert len(dup_names) == 0, f"Report names are not unique: {dup_names}."
+
+    return names
+
+
+def run_batch(
+    file_paths,
+    lab,
+    out_dir,
+    sheet_name="results",
+    par_xlsx=qc.PAR_UNIT_XLSX,
+    stn_xlsx=qc.STATIONS_XLSX,
+    n_jobs=None,
+):
+    """Check templates in parallel, writing one JSON report per file plus a summary.
+
+    Args:
+        file_paths: List of str. Paths to Excel templates
+        lab:        Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+        out_dir:    Str. Folder for reports
+        sheet_name: Str. Name of sheet to read in each template
+        par_xlsx:   Str. Path to 'parameter_unit_mapping.xlsx'
+        stn_xlsx:   Str. Path to Excel file with valid stations
+        n_jobs:     Int or None. Number of worker processes. Default is the number
+                    of CPUs
+
+    Returns:
+        Dataframe summarising the outcome of each rule for each file. Also saved
+        as 'summary.csv' in 'out_dir'.
+    """
+    par_df = pd.read_excel(par_xlsx, sheet_name="to_vannmiljo", keep_default_na=False)
+    cols = qc.get_par_unit_cols(par_df, lab)
+    stn_df = pd.read_excel(stn_xlsx, sheet_name="data")
+    stations = qc.build_station_lookups(stn_df)
+
+    report_names = get_report_names(file_paths)
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(
+        max_workers=n_jobs, initializer=_init_worker, initargs=(cols, stations)
+    ) as executor:
+        reports = list(
+            executor.map(check_template, file_paths, [sheet_name] * len(file_paths))
+        )
+
+    summary = []
+    for report, report_name in zip(reports, report_names):
+        json_path = os.path.join(out_dir, report_name)
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+        for result in report["results"]:
+            summary.append(
+                {
+                    "file": report["file"],
+                    "report": report_name,
+                    "rule": result["rule"],
+                    "severity": result["severity"],
+                    "n_problem_rows": len(result["excel_rows"]),
+                    "message": result["message"],
+                }
+            )
+
+    summary_df = pd.DataFrame(
+        summary,
+        columns=["file", "report", "rule", "severity", "n_problem_rows", "message"],
+    )
+    summary_df.to_csv(os.path.join(out_dir, "summary.csv"), index=False)
+
+    return summary_df
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Apply the QC app's checks to a batch of lab templates."
+    )
+    parser.add_argument("pattern", help="Glob pattern matching the templates to check")
+    parser.add_argument(
+        "--lab", default="Eurofins", choices=["Eurofins", "VestfoldLAB"]
+    )
+    parser.add_argument("--sheet-name", default="results")
+    parser.add_argument("--out-dir", default="./output/batch_qc")
+    parser.add_argument("--par-xlsx", default=qc.PAR_UNIT_XLSX)
+    parser.add_argument("--stn-xlsx", default=qc.STATIONS_XLSX)
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Number of worker processes"
+    )
+    args = parser.parse_args()
+
+    file_paths = sorted(glob.glob(args.pattern))
+    if len(file_paths) == 0:
+        parser.error(f"No files match '{args.pattern}'.")
+
+    summary_df = run_batch(
+        file_paths,
+        args.lab,
+        args.out_dir,
+        sheet_name=args.sheet_name,
+        par_xlsx=args.par_xlsx,
+        stn_xlsx=args.stn_xlsx,
+        n_jobs=args.jobs,
+    )
+
+    counts = summary_df.groupby(["file", "severity"]).size().unstack(fill_value=0)
+    print(counts.to_string())
+    print(f"\nReports saved to '{args.out_dir}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import numpy as np
+
+# Ways of resolving duplicated records. See 'resolve_duplicates'
+POLICIES = ["drop", "average", "first", "last", "flood"]
+
+# Text in the 'resultatkommentar' column marking extra samples taken during floods
+FLOOD_MARKER = "Flomprøve"
+
+# Column added to duplicated records, identifying records with the same key
+GROUP_COL = "dup_group"
+
+
+def get_duplicate_groups(df, key_cols):
+    """Assign an integer ID to each group of records in 'df' sharing the same key.
+    Keys are hashed once, so this is a single pass over the data, however many
+    duplicates there are. Missing values in keys are treated as equal, as in
+    'df.duplicated'.
+
+    Args:
+        df:       Dataframe
+        key_cols: List of str. Columns identifying unique records
+
+    Returns:
+        Array of int, one per row. Duplicated records get IDs numbered from 0 in
+        order of first appearance. Records with a unique key get -1.
+    """
+    ids = (
+        df.groupby(key_cols, sort=False, observed=True, dropna=False)
+        .ngroup()
+        .to_numpy()
+    )
+    sizes = np.bincount(ids, minlength=1)
+    dup_groups = np.flatnonzero(sizes > 1)
+    new_ids = np.full(len(sizes), -1)
+    new_ids[dup_groups] = np.arange(len(dup_groups))
+
+    return new_ids[ids]
+
+
+def is_flood_sample(df, flood_col="resultatkommentar"):
+    """Identify records marked as flood samples (FLOOD_MARKER) in 'flood_col'.
+
+    Args:
+        df:        Dataframe
+        flood_col: Str. Name of comment column
+
+    Returns:
+        Array of bool. All False if 'flood_col' is not in 'df'.
+    """
+    if flood_col not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+
+    return df[flood_col].astype(str).str.contains(FLOOD_MARKER).to_numpy()
+
+
+def find_duplicates(df, key_cols):
+    """Get all records in 'df' that share their key with another record.
+
+    Args:
+        df:       Dataframe
+        key_cols: List of str. Columns identifying unique records
+
+    Returns:
+        Dataframe of duplicated records ordered by group, with a column GROUP_COL
+        identifying each group.
+    """
+    return _duplicated_records(df, get_duplicate_groups(df, key_cols))
+
+
+def _duplicated_records(df, group_ids):
+    """Records in 'df' with a duplicate group ID, ordered by group."""
+    pos = np.flatnonzero(group_ids >= 0)
+    pos = pos[np.argsort(group_ids[pos], kind="stable")]
+
+    return df.iloc[pos].assign(**{GROUP_COL: group_ids[pos]})
+
+
+def _first_in_group(group_ids, last=False):
+    """Positions of the first (or last) record in each duplicate group."""
+    pos = np.flatnonzero(group_ids >= 0)
+    if last:
+        pos = pos[::-1]
+    _, idx = np.unique(group_ids[pos], return_index=True)
+
+    return pos[idx]
+
+
+def resolve_duplicates(
+    df,
+    key_cols,
+    policy="drop",
+    dup_csv=None,
+    value_col="value",
+    flood_col="resultatkommentar",
+    chunk_size=100000,
+):
+    """Find records in 'df' sharing the same key and resolve them using 'policy':
+
+        'drop':    Remove all duplicated records
+        'average': Keep the first record in each group, with 'value_col' replaced
+                   by the mean of the group
+        'first':   Keep the first record in each group
+        'last':    Keep the last record in each group
+        'flood':   Ignore flood samples (see 'is_flood_sample'). Groups left with a
+                   single ordinary sample keep it; other groups are removed
+
+    Args:
+        df:         Dataframe
+        key_cols:   List of str. Columns identifying unique records
+        policy:     Str. One of POLICIES
+        dup_csv:    Raw str or None. If given, duplicated records are written to
+                    this CSV, with a column GROUP_COL identifying each group
+        value_col:  Str. Column to average for policy 'average'
+        flood_col:  Str. Comment column used for policy 'flood'
+        chunk_size: Int. Number of duplicated records written to 'dup_csv' at a
+                    time
+
+    Returns:
+        Tuple of dataframes (df, dup_df). 'df' is the data with duplicates resolved,
+        in the original order. 'dup_df' has all the duplicated records, ordered by
+        group.
+    """
+    assert policy in POLICIES, f"'policy' must be one of {POLICIES}."
+    for name, col in [("average", value_col), ("flood", flood_col)]:
+        if policy == name:
+            assert col in df.columns, f"Dataframe must contain a column named {col}"
+
+    group_ids = get_duplicate_groups(df, key_cols)
+    is_dup = group_ids >= 0
+    n_groups = group_ids.max(initial=-1) + 1
+
+    dup_df = _duplicated_records(df, group_ids)
+    if dup_csv is not None:
+        _write_csv_in_chunks(dup_df, dup_csv, chunk_size)
+
+    keep = ~is_dup
+    if policy in ("average", "first"):
+        keep[_first_in_group(group_ids)] = True
+    elif policy == "last":
+        keep[_first_in_group(group_ids, last=True)] = True
+    elif policy == "flood":
+        ordinary = is_dup & ~is_flood_sample(df, flood_col)
+        n_ordinary = np.bincount(group_ids[ordinary], minlength=n_groups)
+        keep[ordinary] = n_ordinary[group_ids[ordinary]] == 1
+
+    if policy == "average":
+        values = df[value_col].to_numpy(dtype=float, copy=True)
+        valid = is_dup & ~np.isnan(values)
+        sums = np.bincount(group_ids[valid], weights=values[valid], minlength=n_groups)
+        counts = np.bincount(group_ids[valid], minlength=n_groups)
+        with np.errstate(invalid="ignore"):
+            means = sums / counts
+        values[is_dup] = means[group_ids[is_dup]]
+        df = df[keep].assign(**{value_col: values[keep]})
+    else:
+        df = df[keep]
+
+    return (df, dup_df)
+
+
+def _write_csv_in_chunks(df, csv_path, chunk_size):
+    """Write 'df' to CSV 'chunk_size' rows at a time, so the text for the whole frame
+    is never held in memory.
+    """
+    if len(df) == 0:
+        df.to_csv(csv_path, index=False)
+    for start in range(0, len(df), chunk_size):
+        df.iloc[start : start + chunk_size].to_csv(
+            csv_path, mode="w" if start == 0 else "a", header=(start == 0), index=False
+        )
+
+    return None
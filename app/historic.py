@@ -0,0 +1,542 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import qc
+
+# Precomputed summary of the historic data, relative to the root of the repository.
+# Created by 'export_historic_baseline' in '../notebooks/utils.py'
+HISTORIC_BASELINE = r"./data/historic_baseline"
+
+# Columns identifying a data series in 'long' format data
+SERIES_COLS = ["vannmiljo_code", "par", "depth1", "depth2"]
+
+# Columns identifying where a sample was taken. A data series is a site plus 'par'
+SITE_COLS = ["vannmiljo_code", "depth1", "depth2"]
+
+# Robust statistics of the historic data for each site, parameter and month, held in
+# dense arrays of shape (len(sites), len(pars), 13). Month 0 covers all months
+# together. See 'fit_robust_model'
+RobustModel = namedtuple("RobustModel", "sites pars count median scale")
+
+# Summary statistics for each data series in the historic data
+STATS_COLS = [
+    "count",
+    "min",
+    "q1",
+    "median",
+    "q3",
+    "max",
+    "freq_min",
+    "freq_median",
+    "freq_max",
+]
+
+# Summaries of the historic data used for checking new data. 'stats' is the output
+# of 'get_historic_stats' and 'sampling' the output of 'get_sampling_stats'
+Baseline = namedtuple("Baseline", "stats sampling")
+
+
+def get_iqr_limits(his_df):
+    """Get the number of values and the lower and upper quartiles for each data series
+    in the historic data.
+
+    Args:
+        his_df: Dataframe. Historic data in 'long' format, with columns 'SERIES_COLS'
+                and 'value'
+
+    Returns:
+        Dataframe with columns 'SERIES_COLS', 'count', 'q1' and 'q3'.
+    """
+    grouped = his_df.groupby(SERIES_COLS, observed=True)["value"]
+    limits = pd.DataFrame(
+        {
+            "count": grouped.count(),
+            "q1": grouped.quantile(0.25),
+            "q3": grouped.quantile(0.75),
+        }
+    ).reset_index()
+
+    return limits
+
+
+def flag_iqr_outliers(new_df, limits, iqr_fac=3, min_count=50):
+    """Flag new values that are more than 'iqr_fac' * IQR above the upper quartile or
+    below the lower quartile for the same series in the historic data. Only series with
+    more than 'min_count' historic values are considered.
+
+    Args:
+        new_df:    Dataframe. New data in 'long' format, with columns 'SERIES_COLS'
+                   and 'value'
+        limits:    Dataframe. Historic quartiles (see 'get_iqr_limits')
+        iqr_fac:   Float. Multiple of the IQR beyond the quartiles for outliers
+        min_count: Int. Series with this many historic values or fewer are ignored
+
+    Returns:
+        Dataframe. Rows of 'new_df' for series with enough historic data, with new
+        columns 'count', 'q1', 'q3' and 'outlier' (1 for outliers, otherwise 0).
+    """
+    limits = limits[limits["count"] > min_count]
+    df = new_df.merge(limits, on=SERIES_COLS, how="inner")
+
+    iqr = df["q3"] - df["q1"]
+    is_outlier = (df["value"] > df["q3"] + iqr_fac * iqr) | (
+        df["value"] < df["q1"] - iqr_fac * iqr
+    )
+    df["outlier"] = is_outlier.astype(int)
+
+    return df
+
+
+def find_timeseries_outliers(df, iqr_fac=3, min_count=50):
+    """Identify outliers in the new data for each data series, based on the historic
+    IQR for the same series. Series need more than 'min_count' historic values and at
+    least one new value.
+
+    Args:
+        df:        Dataframe. Historic and new data in 'long' format, with columns
+                   'SERIES_COLS', 'sample_date', 'period' and 'value'
+        iqr_fac:   Float. Multiple of the IQR beyond the quartiles for outliers
+        min_count: Int. Series with this many historic values or fewer are ignored
+
+    Returns:
+        Dataframe. Outlying new records, with the columns in 'df' plus 'outlier',
+        sorted by series and date.
+    """
+    his_df = df[df["period"] == "historic"]
+    new_df = df[df["period"] == "new"]
+    limits = get_iqr_limits(his_df)
+    out_df = flag_iqr_outliers(new_df, limits, iqr_fac=iqr_fac, min_count=min_count)
+
+    out_df = out_df.loc[out_df["outlier"] == 1, list(df.columns) + ["outlier"]]
+    out_df = out_df.sort_values(SERIES_COLS + ["sample_date"], kind="stable")
+
+    return out_df.reset_index(drop=True)
+
+
+def _group_medians(group_idx, values, n_groups):
+    """Median of 'values' in each of 'n_groups' groups. Values are replaced by their
+    rank, so a single sort of integer keys orders them by group and then by value.
+    Groups with no values get NaN.
+    """
+    uniques, ranks = np.unique(values, return_inverse=True)
+    keys = group_idx.astype(np.int64) * len(uniques) + ranks
+    keys.sort()
+    values = uniques[keys % len(uniques)]
+    counts = np.bincount(group_idx, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    has_data = counts > 0
+    lower = values[(starts + (counts - 1) // 2)[has_data]]
+    upper = values[(starts + counts // 2)[has_data]]
+    medians = np.full(n_groups, np.nan)
+    medians[has_data] = (lower + upper) / 2
+
+    return medians
+
+
+def fit_robust_model(his_df):
+    """Get the median and a robust scale for every site, parameter and month in the
+    historic data. All series are summarised together using array operations, with
+    no loop over groups.
+
+    The scale is 1.4826 * MAD (median absolute deviation), which equals the standard
+    deviation for normally distributed data. Where more than half the values are
+    identical (e.g. at the limit of detection) the MAD is zero, so 1.2533 * the mean
+    absolute deviation is used instead. Series with no spread at all get a NaN scale.
+
+    Args:
+        his_df: Dataframe. Historic data in 'long' format, with columns 'SITE_COLS',
+                'par', 'sample_date' and 'value'
+
+    Returns:
+        RobustModel. 'sites' is a MultiIndex of 'SITE_COLS' and 'pars' an Index of
+        parameter names, giving the positions along the first two axes of the
+        arrays.
+    """
+    df = his_df.dropna(subset=["value"])
+    site_idx = (
+        df.groupby(SITE_COLS, sort=False, observed=True, dropna=False)
+        .ngroup()
+        .to_numpy()
+    )
+    sites = pd.MultiIndex.from_frame(df[SITE_COLS].drop_duplicates())
+    par_idx, pars = pd.factorize(df["par"])
+    month = df["sample_date"].dt.month.to_numpy()
+    values = df["value"].to_numpy(dtype=float)
+    shape = (len(sites), len(pars), 13)
+    n_groups = np.prod(shape)
+
+    # Each value belongs to the group for its month and to the group for month 0
+    series_idx = (site_idx * len(pars) + par_idx) * 13
+    group_idx = np.concatenate([series_idx + month, series_idx])
+    values = np.concatenate([values, values])
+
+    count = np.bincount(group_idx, minlength=n_groups)
+    median = _group_medians(group_idx, values, n_groups)
+    abs_dev = np.abs(values - median[group_idx])
+    mad = _group_medians(group_idx, abs_dev, n_groups)
+    with np.errstate(invalid="ignore"):
+        mean_ad = np.bincount(group_idx, weights=abs_dev, minlength=n_groups) / count
+    scale = np.where(mad > 0, 1.4826 * mad, 1.2533 * mean_ad)
+    scale[~(scale > 0)] = np.nan
+
+    model = RobustModel(
+        sites,
+        pd.Index(np.asarray(pars, dtype=object)),
+        count.reshape(shape),
+        median.reshape(shape),
+        scale.reshape(shape),
+    )
+
+    return model
+
+
+def score_robust_outliers(new_df, model, z_thresh=3.5, seasonal=True, min_count=10):
+    """Score new values against the historic median and scale for the same series,
+    as robust z-scores: (value - median) / scale. Values with an absolute score above
+    'z_thresh' are flagged. All values are scored in one vectorised lookup into the
+    arrays of 'model'.
+
+    Args:
+        new_df:    Dataframe. New data in 'long' format, with columns 'SITE_COLS',
+                   'par', 'sample_date' and 'value'
+        model:     RobustModel. Output from 'fit_robust_model'
+        z_thresh:  Float. Absolute robust z-score above which values are outliers
+        seasonal:  Bool. Whether to compare with historic values from the same month.
+                   Months with fewer than 'min_count' historic values fall back to
+                   the statistics for all months
+        min_count: Int. Series with fewer historic values than this are ignored
+
+    Returns:
+        Dataframe. Rows of 'new_df' for series with enough historic data, with new
+        columns 'count', 'median', 'scale', 'robust_z' and 'outlier' (1 for outliers,
+        otherwise 0).
+    """
+    site_idx = model.sites.get_indexer(pd.MultiIndex.from_frame(new_df[SITE_COLS]))
+    par_idx = model.pars.get_indexer(new_df["par"])
+    known = (site_idx >= 0) & (par_idx >= 0)
+    site_idx, par_idx = site_idx[known], par_idx[known]
+    if seasonal:
+        month = new_df["sample_date"].dt.month.to_numpy()[known]
+        month = np.where(model.count[site_idx, par_idx, month] >= min_count, month, 0)
+    else:
+        month = np.zeros(len(site_idx), dtype=int)
+
+    stats = {
+        name: getattr(model, name)[site_idx, par_idx, month]
+        for name in ["count", "median", "scale"]
+    }
+    enough = (stats["count"] >= min_count) & ~np.isnan(stats["scale"])
+    stats = {name: arr[enough] for name, arr in stats.items()}
+    df = new_df[known][enough]
+
+    robust_z = (df["value"].to_numpy(dtype=float) - stats["median"]) / stats["scale"]
+    df = df.assign(
+        **stats,
+        robust_z=robust_z,
+        outlier=(np.abs(robust_z) > z_thresh).astype(int),
+    )
+
+    return df
+
+
+def find_robust_outliers(df, z_thresh=3.5, seasonal=True, min_count=10):
+    """Identify outliers in the new data for each data series, based on the median
+    and robust scale of the historic data for the same series (and month, if
+    'seasonal'). See 'fit_robust_model' and 'score_robust_outliers'.
+
+    Args:
+        df:        Dataframe. Historic and new data in 'long' format, with columns
+                   'SERIES_COLS', 'sample_date', 'period' and 'value'
+        z_thresh:  Float. Absolute robust z-score above which values are outliers
+        seasonal:  Bool. Whether to compare with historic values from the same month
+        min_count: Int. Series with fewer historic values than this are ignored
+
+    Returns:
+        Dataframe. Outlying new records, with the columns in 'df' plus 'median',
+        'scale', 'robust_z' and 'outlier', sorted by series and date.
+    """
+    model = fit_robust_model(df[df["period"] == "historic"])
+    out_df = score_robust_outliers(
+        df[df["period"] == "new"],
+        model,
+        z_thresh=z_thresh,
+        seasonal=seasonal,
+        min_count=min_count,
+    )
+
+    out_cols = list(df.columns) + ["median", "scale", "robust_z", "outlier"]
+    out_df = out_df.loc[out_df["outlier"] == 1, out_cols]
+    out_df = out_df.sort_values(SERIES_COLS + ["sample_date"], kind="stable")
+
+    return out_df.reset_index(drop=True)
+
+
+def get_historic_stats(his_df):
+    """Summarise the historic data for each data series and month. For each series,
+    rows with 'month' = 0 summarise all months together.
+
+    The sampling frequency columns give the minimum, median and maximum number of
+    values per month (per year-month for 'month' = 0), considering only months where
+    the series was sampled.
+
+    Args:
+        his_df: Dataframe. Historic data in 'long' format, with columns 'SERIES_COLS',
+                'sample_date' and 'value'
+
+    Returns:
+        Dataframe with columns 'SERIES_COLS', 'month' and 'STATS_COLS'.
+    """
+    df = his_df[SERIES_COLS + ["value"]]
+    year = his_df["sample_date"].dt.year.to_numpy()
+    month = his_df["sample_date"].dt.month.to_numpy()
+    df = pd.concat(
+        [
+            df.assign(month=0, period=year * 100 + month),
+            df.assign(month=month, period=year),
+        ],
+        ignore_index=True,
+    )
+    key_cols = SERIES_COLS + ["month"]
+
+    grouped = df.groupby(key_cols, observed=True)["value"]
+    stats = pd.DataFrame(
+        {
+            "count": grouped.count(),
+            "min": grouped.min(),
+            "q1": grouped.quantile(0.25),
+            "median": grouped.median(),
+            "q3": grouped.quantile(0.75),
+            "max": grouped.max(),
+        }
+    )
+
+    freq = (
+        df.groupby(key_cols + ["period"], observed=True)
+        .size()
+        .groupby(key_cols, observed=True)
+        .agg(["min", "median", "max"])
+        .add_prefix("freq_")
+    )
+    stats = stats.join(freq).reset_index()
+
+    return stats[SERIES_COLS + ["month"] + STATS_COLS]
+
+
+def get_sampling_stats(smp_df):
+    """Get the minimum, median and maximum number of samples per month at each
+    station, considering only year-months when the station was sampled. Samples at
+    different depths are counted separately.
+
+    Args:
+        smp_df: Dataframe. Samples, with columns 'vannmiljo_code', 'sample_date',
+                'depth1' and 'depth2'. Duplicated samples are ignored
+
+    Returns:
+        Dataframe with columns 'vannmiljo_code', 'month', 'freq_min', 'freq_median'
+        and 'freq_max'.
+    """
+    smp_df = smp_df[["vannmiljo_code", "sample_date", "depth1", "depth2"]]
+    smp_df = smp_df.drop_duplicates()
+    counts = smp_df.groupby(
+        [
+            smp_df["vannmiljo_code"],
+            smp_df["sample_date"].dt.year.rename("year"),
+            smp_df["sample_date"].dt.month.rename("month"),
+        ],
+        observed=True,
+    ).size()
+    sampling = (
+        counts.groupby(["vannmiljo_code", "month"], observed=True)
+        .agg(["min", "median", "max"])
+        .add_prefix("freq_")
+        .reset_index()
+    )
+
+    return sampling
+
+
+def save_baseline(baseline, out_dir=HISTORIC_BASELINE):
+    """Save a Baseline as compressed Parquet files in 'out_dir'.
+
+    Args:
+        baseline: Baseline. Historic summaries
+        out_dir:  Raw str. Folder for output
+
+    Returns:
+        None.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in baseline._asdict().items():
+        df = df.astype({"vannmiljo_code": "category"})
+        if "par" in df.columns:
+            df = df.astype({"par": "category"})
+        df.to_parquet(os.path.join(out_dir, f"{name}.parquet"), index=False)
+
+    return None
+
+
+def read_baseline(in_dir=HISTORIC_BASELINE):
+    """Read a Baseline saved by 'save_baseline'.
+
+    Args:
+        in_dir: Raw str. Folder containing the baseline
+
+    Returns:
+        Baseline, or None if the baseline does not exist.
+    """
+    paths = {name: os.path.join(in_dir, f"{name}.parquet") for name in Baseline._fields}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+
+    baseline = Baseline(
+        **{
+            name: pd.read_parquet(path).astype({"vannmiljo_code": str})
+            for name, path in paths.items()
+        }
+    )
+
+    return baseline
+
+
+def template_to_long(df, parsed, registry, lab):
+    """Convert numeric values from a tidied template to 'long' format, using
+    Vannmiljø parameter names and units so they can be compared with the historic
+    data.
+
+    Args:
+        df:       Dataframe of submitted water chemistry data
+        parsed:   ParsedData. Output from 'qc.parse_numeric(df)'
+        registry: ParRegistry. Parameter mappings (see 'qc.build_par_registry')
+        lab:      Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+
+    Returns:
+        Dataframe with columns 'row' (index of the record in 'df'),
+        'vannmiljo_code', 'sample_date', 'depth1', 'depth2', 'par' and 'value'.
+    """
+    lookup = registry.labs[lab]
+    cols = [col for col in lookup.index if col in parsed.values.columns]
+    par_idx = lookup.index.get_indexer(cols)
+
+    # Scale each column by its conversion factor before reshaping
+    values = parsed.values[cols] * lookup.factors[par_idx]
+    values.columns = lookup.vm_par_units[par_idx]
+    long_df = values.stack().reset_index()
+    long_df.columns = ["row", "par", "value"]
+    id_df = df[["vannmiljo_code", "sample_date", "depth1", "depth2"]].copy()
+    for col in ["depth1", "depth2"]:
+        id_df[col] = pd.to_numeric(id_df[col], errors="coerce")
+    long_df = long_df.merge(id_df, left_on="row", right_index=True)
+
+    return long_df[
+        ["row", "vannmiljo_code", "sample_date", "depth1", "depth2", "par", "value"]
+    ]
+
+
+def _check_result(df, name, title, group, **outcome):
+    """Build a qc.CheckResult, using the same defaults as 'qc.run_checks'."""
+    result = {
+        "severity": "ok",
+        "message": "",
+        "details": [],
+        "tables": [],
+        "rows": df.index[:0],
+    }
+    result.update(outcome)
+
+    return qc.CheckResult(name, title, group, **result)
+
+
+def run_historic_checks(df, parsed, baseline, registry, lab, iqr_fac=3, min_count=50):
+    """Compare a template with the historic data for the same stations. Checks for
+    (i) values outside the historic IQR envelope for each data series (see
+    'flag_iqr_outliers') and (ii) stations sampled less often in any month than
+    the historic minimum for that month.
+
+    Args:
+        df:        Dataframe of submitted water chemistry data
+        parsed:    ParsedData. Output from 'qc.parse_numeric(df)'
+        baseline:  Baseline. Historic summaries (see 'read_baseline')
+        registry:  ParRegistry. Parameter mappings (see 'qc.build_par_registry')
+        lab:       Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+        iqr_fac:   Float. Multiple of the IQR beyond the quartiles for outliers
+        min_count: Int. Series with this many historic values or fewer are ignored
+
+    Returns:
+        Generator of qc.CheckResult.
+    """
+    group = "Checking against historic data"
+
+    # Values outside historic envelope
+    long_df = template_to_long(df, parsed, registry, lab)
+    limits = baseline.stats.loc[baseline.stats["month"] == 0, SERIES_COLS + STATS_COLS]
+    out_df = flag_iqr_outliers(long_df, limits, iqr_fac=iqr_fac, min_count=min_count)
+    out_df = out_df[out_df["outlier"] == 1]
+    iqr = out_df["q3"] - out_df["q1"]
+    out_df = out_df.assign(
+        lower_limit=out_df["q1"] - iqr_fac * iqr,
+        upper_limit=out_df["q3"] + iqr_fac * iqr,
+    )
+    outcome = {}
+    if len(out_df) > 0:
+        n_stns = out_df["vannmiljo_code"].nunique()
+        outcome = {
+            "severity": "warning",
+            "message": "Some values are unusual compared to the historic data.",
+            "details": [
+                f"There are **{len(out_df)}** values from **{n_stns}** stations "
+                f"that are more than {iqr_fac} times the IQR above or below the "
+                "historic IQR for the same station, parameter and depth. Values "
+                "and limits are in Vannmiljø units."
+            ],
+            "tables": [
+                (
+                    "",
+                    out_df[
+                        qc.ID_COLS
+                        + ["par", "value", "lower_limit", "upper_limit", "count"]
+                    ].rename(columns={"count": "historic_count"}),
+                )
+            ],
+            "rows": pd.Index(out_df["row"].unique()),
+        }
+    yield _check_result(df, "historic_iqr", "Historic range", group, **outcome)
+
+    # Sampling frequency
+    new_df = df[["vannmiljo_code", "sample_date", "depth1", "depth2"]]
+    new_df = new_df.drop_duplicates()
+    cnt_df = (
+        new_df.groupby(
+            [new_df["vannmiljo_code"], new_df["sample_date"].dt.month.rename("month")]
+        )
+        .size()
+        .rename("new")
+        .reset_index()
+        .merge(baseline.sampling, on=["vannmiljo_code", "month"], how="inner")
+    )
+    below_df = cnt_df[cnt_df["new"] < cnt_df["freq_min"]].reset_index(drop=True)
+    outcome = {}
+    if len(below_df) > 0:
+        below_stns = below_df["vannmiljo_code"].unique()
+        stn_months = pd.MultiIndex.from_arrays(
+            [df["vannmiljo_code"], df["sample_date"].dt.month]
+        )
+        outcome = {
+            "severity": "warning",
+            "message": "Some stations have fewer samples than usual.",
+            "details": [
+                f"There are **{len(below_stns)}** stations where the number of "
+                "samples in a month is lower than the lowest number of samples "
+                "for that month in the historic data. Are any samples missing?"
+            ],
+            "tables": [("", below_df)],
+            "rows": df.index[
+                stn_months.isin(
+                    pd.MultiIndex.from_frame(below_df[["vannmiljo_code", "month"]])
+                )
+            ],
+        }
+    yield _check_result(
+        df, "sampling_frequency", "Sampling frequency", group, **outcome
+    )
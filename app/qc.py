@@ -0,0 +1,854 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from itertools import zip_longest
+
+import duplicates
+import numpy as np
+import openpyxl
+import pandas as pd
+
+# Reference datasets, relative to the root of the repository
+PAR_UNIT_XLSX = r"./data/parameter_unit_mapping.xlsx"
+STATIONS_XLSX = r"./data/all_stations_2025-11-13.xlsx"
+
+# Sample details that must be present in every template, keyed by their name in
+# row 3 of the sheet
+TEMPLATE_ID_COLS = {
+    "Lokalitets-ID": "vannmiljo_code",
+    "Prøvested": "station_name",
+    "Prøvedato": "sample_date",
+    "Dybde": "depth1",
+}
+
+# Comment columns that are read if present. Older templates do not have them
+TEMPLATE_OPTIONAL_COLS = {
+    "Labreferanse": "labreferanse",
+    "Resultatkommentar": "resultatkommentar",
+}
+
+# Columns to read from a template, as found by 'get_template_layout'. 'names' and
+# 'positions' (zero-based) are in the order of the parsed dataframe. 'missing' lists
+# required columns not found in the header
+TemplateLayout = namedtuple("TemplateLayout", "names positions missing")
+
+# Cell text treated as missing, as in 'pd.read_excel'
+NA_STRINGS = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+# Columns in the tidied template that do not hold numeric data
+NON_NUMERIC_COLS = [
+    "vannmiljo_code",
+    "station_name",
+    "sample_date",
+    "labreferanse",
+    "resultatkommentar",
+]
+
+# Columns used to identify samples in tables of problem rows
+ID_COLS = ["vannmiljo_code", "sample_date", "depth1", "depth2"]
+
+# Parameters that should be reported in every template
+EXPECTED_COLS = [
+    "pH_enh",
+    "Kond_ms/m",
+    "Alk_mmol/l",
+    "Tot-P_µg/l",
+    "Tot-N_µg/l",
+    "NO3_µg/l",
+    "TOC_mg/l",
+    "RAl_µg/l",
+    "ILAl_µg/l",
+    "LAl_µg/l",
+    "Cl_mg/l",
+    "SO4_mg/l",
+    "Ca_mg/l",
+    "K_mg/l",
+    "Mg_mg/l",
+    "Na_mg/l",
+    "SIO2_µg/l",
+    "ANC_µekv/l",
+]
+
+# Parameters that should always be greater than zero
+GT_ZERO_COLS = [
+    "pH_enh",
+    "Kond_ms/m",
+    "Alk_mmol/l",
+    "Tot-P_µg/l",
+    "Tot-N_µg/l",
+    "NO3_µg/l",
+    "TOC_mg/l",
+    "RAl_µg/l",
+    "ILAl_µg/l",
+    "Cl_mg/l",
+    "SO4_mg/l",
+    "Ca_mg/l",
+    "K_mg/l",
+    "Mg_mg/l",
+    "Na_mg/l",
+    "SIO2_µg/l",
+]
+
+# Numeric representation of the template, built once per upload by 'parse_numeric'
+ParsedData = namedtuple("ParsedData", ["values", "lod", "non_numeric"])
+
+# Reference station data and precomputed lookups, built by 'build_station_lookups'
+StationLookups = namedtuple(
+    "StationLookups", ["stn_df", "codes", "names", "name_codes"]
+)
+
+# Parameter mappings keyed by 'index', as read-only arrays aligned with it. Built by
+# 'build_par_registry'
+ParLookup = namedtuple(
+    "ParLookup",
+    ["index", "vm_ids", "vm_units", "vm_par_units", "factors", "mins", "maxs"],
+)
+
+# Parameter mappings from 'parameter_unit_mapping.xlsx'. 'labs' maps each lab to a
+# ParLookup keyed by the lab's 'par_unit'; 'vannmiljo' is keyed by Vannmiljø
+# parameter ID, with conversion factors of 1
+ParRegistry = namedtuple("ParRegistry", ["par_df", "labs", "vannmiljo"])
+
+# Station problems identified in a template, returned by 'find_station_issues'
+StationIssues = namedtuple(
+    "StationIssues",
+    ["missing_code_names", "unknown_codes", "multi_named_codes", "multi_coded_names"],
+)
+
+# A registered QC rule. See 'register_rule'
+Rule = namedtuple("Rule", ["name", "title", "group", "func"])
+
+# Outcome of applying a rule to a template. 'severity' is one of 'ok', 'warning'
+# or 'error'; 'details' is a list of Markdown strings and 'tables' a list of
+# (caption, dataframe) tuples; 'rows' is an Index of offending row labels
+CheckResult = namedtuple(
+    "CheckResult",
+    ["rule", "title", "group", "severity", "message", "details", "tables", "rows"],
+)
+
+# Rules in the order they are applied
+RULES = []
+
+
+def register_rule(name, title, group=None):
+    """Decorator adding a function to the QC rule registry. Rule functions take the
+    arguments (df, parsed, stations) and return a dict with any of the keys
+    'severity', 'message', 'details', 'tables' and 'rows'.
+
+    Args:
+        name:  Str. Unique identifier for the rule
+        title: Str. Heading used when reporting results
+        group: Str or None. Optional heading for a group of related rules
+
+    Returns:
+        Decorator.
+    """
+
+    def decorator(func):
+        assert name not in [rule.name for rule in RULES], f"Rule '{name}' exists."
+        RULES.append(Rule(name, title, group, func))
+        return func
+
+    return decorator
+
+
+def run_checks(df, stations, parsed=None, rules=None):
+    """Apply QC rules to a template. Results are yielded as each rule completes, so
+    they can be reported progressively. Checking stops after the first rule with
+    severity 'error', as later rules depend on the data being parseable.
+
+    Args:
+        df:       Dataframe of sumbitted water chemistry data
+        stations: StationLookups. Output from 'build_station_lookups'
+        parsed:   ParsedData or None. Output from 'parse_numeric(df)'. Calculated
+                  if not supplied
+        rules:    List of str or None. Names of rules to apply. Default is all
+                  rules in RULES
+
+    Returns:
+        Generator of CheckResult.
+    """
+    if parsed is None:
+        parsed = parse_numeric(df)
+
+    for rule in RULES:
+        if (rules is not None) and (rule.name not in rules):
+            continue
+        outcome = {
+            "severity": "ok",
+            "message": "",
+            "details": [],
+            "tables": [],
+            "rows": df.index[:0],
+        }
+        outcome.update(rule.func(df, parsed, stations))
+        result = CheckResult(rule.name, rule.title, rule.group, **outcome)
+        yield result
+
+        if result.severity == "error":
+            break
+
+
+def format_result(result):
+    """Format a CheckResult as plain text, for use in notebooks and on the command
+    line.
+
+    Args:
+        result: CheckResult.
+
+    Returns:
+        Str.
+    """
+    lines = [f"\n{result.title}:"]
+    for detail in result.details:
+        for line in detail.strip("\n").split("\n"):
+            if line.startswith("```"):
+                continue
+            lines.append("    " + re.sub(r"\*\*|`", "", line).strip())
+    for caption, table in result.tables:
+        lines.append("    " + re.sub(r"\*\*|`", "", caption))
+        lines.append(table.to_string())
+
+    if result.severity == "ok":
+        lines.append("    Done.")
+    else:
+        lines.append(f"    {result.severity.upper()}: {result.message}")
+
+    return "\n".join(lines)
+
+
+def get_par_unit_cols(par_df, lab):
+    """Get the 'par_unit' column names used in the template for 'lab'.
+
+    Args:
+        par_df: Dataframe. Parameter mappings from 'parameter_unit_mapping.xlsx'
+        lab:    Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+
+    Returns:
+        List of str.
+    """
+    assert lab in [
+        "VestfoldLAB",
+        "Eurofins",
+    ], "'lab' must be one of ['VestfoldLAB', 'Eurofins']."
+
+    cols = list(par_df[f"{lab.lower()}_name"] + "_" + par_df[f"{lab.lower()}_unit"])
+
+    return cols
+
+
+def parse_data_template(file_path, cols, sheet_name="results"):
+    """Parse lab data from the agreed template in 'wide' format, without reporting
+    any problems. See 'read_data_template' in the app for details.
+
+    The columns to read are located from the header rows (see
+    'get_template_layout'), so templates with extra, missing or reordered columns
+    are handled without changes to the code. Rows are then streamed using openpyxl
+    in read-only mode and only the columns needed are kept.
+
+    Columns holding only numbers are float, 'sample_date' is datetime and 'depth1'
+    and 'depth2' are filled assuming depth 0. Columns with text (e.g. LOD values like
+    '<2') are left as objects for 'parse_numeric'.
+
+    Args:
+        file_path:  Raw str or file-like. Excel template
+        cols:       List of str. Required 'par_unit' columns, as used by the lab
+                    submitting the data (see 'get_par_unit_cols')
+        sheet_name: Str. Name of sheet to read
+
+    Returns:
+        Tuple (df, missing_cols). 'df' is None if any required columns are missing.
+    """
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        # Row 2 of the sheet holds parameter names and row 3 the units (or names of
+        # sample details); data start in row 4
+        rows = wb[sheet_name].iter_rows(min_row=2, values_only=True)
+        layout = get_template_layout(next(rows, ()), next(rows, ()), tuple(cols))
+        if len(layout.missing) > 0:
+            return (None, list(layout.missing))
+
+        # Keep only the columns of interest as each row is read
+        n_cols = max(layout.positions) + 1
+        data = []
+        n_rows = 0
+        for row in rows:
+            if len(row) < n_cols:
+                row = row + (None,) * (n_cols - len(row))
+            data.append([row[idx] for idx in layout.positions])
+            if any(value is not None for value in row):
+                n_rows = len(data)
+    finally:
+        wb.close()
+
+    # Drop empty rows at the end of the sheet
+    data = data[:n_rows]
+
+    # Build typed columns
+    values = list(zip(*data)) if len(data) > 0 else [()] * len(layout.names)
+    df = pd.DataFrame(
+        {
+            pos: _typed_column(col_values, layout.names[pos] in NON_NUMERIC_COLS)
+            for pos, col_values in enumerate(values)
+        }
+    )
+    df.columns = layout.names
+    df.index = pd.RangeIndex(2, len(data) + 2)
+
+    # Tidy
+    df["depth1"] = df["depth1"].fillna(0)  # Assume depth is 0 unless otherwise stated
+    df.insert(df.columns.get_loc("depth1") + 1, "depth2", df["depth1"])
+    df["sample_date"] = pd.to_datetime(df["sample_date"])
+
+    return (df, [])
+
+
+@lru_cache(maxsize=64)
+def get_template_layout(pars, units, cols):
+    """Locate the columns needed from a template by scanning its header rows. Sample
+    details are found by name in row 3 and parameters by '<par>_<unit>' from rows 2
+    and 3. If a name appears more than once, the first column is used.
+
+    Layouts are cached on the header rows and 'cols', so templates sharing a layout
+    are only scanned once.
+
+    Args:
+        pars:  Tuple. Values in row 2 of the sheet
+        units: Tuple. Values in row 3 of the sheet
+        cols:  Tuple of str. Required 'par_unit' columns
+
+    Returns:
+        TemplateLayout. The sample details come first, followed by 'cols' and any
+        optional comment columns present. 'missing' lists required columns not
+        found, by their name in the template.
+    """
+    found = {}
+    for idx, (par, unit) in enumerate(zip_longest(pars, units)):
+        if unit in TEMPLATE_ID_COLS:
+            name = TEMPLATE_ID_COLS[unit]
+        elif unit in TEMPLATE_OPTIONAL_COLS:
+            name = TEMPLATE_OPTIONAL_COLS[unit]
+        else:
+            name = f"{par}_{unit}"
+        found.setdefault(name, idx)
+
+    missing = [
+        label for label, name in TEMPLATE_ID_COLS.items() if name not in found
+    ] + [col for col in cols if col not in found]
+    if len(missing) > 0:
+        return TemplateLayout((), (), tuple(missing))
+
+    names = (
+        list(TEMPLATE_ID_COLS.values())
+        + list(cols)
+        + [name for name in TEMPLATE_OPTIONAL_COLS.values() if name in found]
+    )
+
+    return TemplateLayout(tuple(names), tuple(found[name] for name in names), ())
+
+
+def _typed_column(values, is_text):
+    """Convert a column of cell values to a Series, using float for columns holding
+    only numbers. Other columns are returned as objects. Text in NA_STRINGS is
+    treated as missing.
+    """
+    ser = pd.Series(values, dtype=object)
+    ser = ser.mask(ser.isna() | ser.isin(NA_STRINGS), np.nan)
+    if (not is_text) and pd.api.types.infer_dtype(ser, skipna=True) in (
+        "integer",
+        "floating",
+        "mixed-integer-float",
+        "empty",
+    ):
+        return ser.astype(float)
+
+    return ser
+
+
+def parse_numeric(df):
+    """Parse all numeric columns in 'df' in a single pass. Columns that are already
+    numeric are used as they are. For other columns, values are first parsed
+    directly; only entries that fail (e.g. LOD values like '<2,0' or decimal commas)
+    are then cleaned as strings and parsed again.
+
+    Args:
+        df: Dataframe of sumbitted water chemistry data
+
+    Returns:
+        ParsedData tuple of dataframes (values, lod, non_numeric), all with the
+        same index and numeric columns as 'df':
+            values:      Float. Parsed values, with NaN where data are missing or
+                         cannot be parsed
+            lod:         Bool. True where the value is reported as an LOD ('<')
+            non_numeric: Bool. True where a value is present but cannot be parsed
+    """
+    num_cols = [col for col in df.columns if col not in NON_NUMERIC_COLS]
+    shape = (len(df), len(num_cols))
+    values = np.empty(shape, dtype=float)
+    lod = np.zeros(shape, dtype=bool)
+    non_numeric = np.zeros(shape, dtype=bool)
+
+    # Columns already typed as numbers by 'parse_data_template' need no parsing
+    is_obj = np.array([df[col].dtype == object for col in num_cols], dtype=bool)
+    num_arr = np.array(num_cols, dtype=object)
+    values[:, ~is_obj] = df[list(num_arr[~is_obj])].to_numpy(dtype=float)
+
+    if is_obj.any():
+        raw = pd.Series(df[list(num_arr[is_obj])].to_numpy(dtype=object).ravel())
+        obj_values = pd.to_numeric(raw, errors="coerce")
+
+        # Only strings that could not be parsed directly need cleaning
+        present = raw.notna().to_numpy()
+        retry = present & obj_values.isna().to_numpy()
+        obj_lod = np.zeros(len(raw), dtype=bool)
+        obj_values = obj_values.to_numpy(dtype=float)
+        if retry.any():
+            txt = raw[retry].astype(str)
+            obj_lod[retry] = txt.str.contains("<").to_numpy()
+            obj_values[retry] = pd.to_numeric(
+                txt.str.strip("<").str.replace(",", "."), errors="coerce"
+            ).to_numpy(dtype=float)
+
+        obj_shape = (len(df), is_obj.sum())
+        values[:, is_obj] = obj_values.reshape(obj_shape)
+        lod[:, is_obj] = obj_lod.reshape(obj_shape)
+        non_numeric[:, is_obj] = (present & np.isnan(obj_values)).reshape(obj_shape)
+
+    parsed = ParsedData(
+        *[
+            pd.DataFrame(arr, index=df.index, columns=num_cols)
+            for arr in (values, lod, non_numeric)
+        ]
+    )
+
+    return parsed
+
+
+def build_station_lookups(stn_df):
+    """Build lookups from the definitive station list.
+
+    Args:
+        stn_df: Dataframe of reference station details
+
+    Returns:
+        StationLookups tuple (stn_df, codes, names, name_codes):
+            stn_df:     Dataframe of reference station details
+            codes:      Frozenset of valid Vannmiljø station codes
+            names:      Dict mapping Vannmiljø station code to station name
+            name_codes: Dict mapping station name to a tuple of Vannmiljø codes
+    """
+    stn_df2 = stn_df.dropna(subset=["vannmiljo_code"])
+    stations = StationLookups(
+        stn_df=stn_df,
+        codes=frozenset(stn_df2["vannmiljo_code"]),
+        names=dict(zip(stn_df2["vannmiljo_code"], stn_df2["station_name"])),
+        name_codes=stn_df2.groupby("station_name")["vannmiljo_code"]
+        .agg(tuple)
+        .to_dict(),
+    )
+
+    return stations
+
+
+def build_par_registry(par_df, labs=("VestfoldLAB", "Eurofins")):
+    """Build lookups from the parameter mappings, once, so that unit conversions and
+    range checks are array lookups rather than merges.
+
+    Args:
+        par_df: Dataframe. Parameter mappings from 'parameter_unit_mapping.xlsx'
+        labs:   Tuple of str. Labs to build lookups for
+
+    Returns:
+        ParRegistry tuple (par_df, labs, vannmiljo):
+            par_df:    Dataframe. Parameter mappings, which should not be modified
+            labs:      Dict mapping lab name to ParLookup
+            vannmiljo: ParLookup keyed by Vannmiljø parameter ID
+    """
+    registry = ParRegistry(
+        par_df=par_df.copy(),
+        labs={
+            lab: _par_lookup(
+                par_df,
+                get_par_unit_cols(par_df, lab),
+                par_df[f"{lab.lower()}_to_vm_conv_fac"],
+            )
+            for lab in labs
+        },
+        vannmiljo=_par_lookup(par_df, par_df["vannmiljo_id"], np.ones(len(par_df))),
+    )
+
+    return registry
+
+
+def _par_lookup(par_df, keys, factors):
+    """ParLookup for the rows of 'par_df', keyed by 'keys'. Arrays are copied and made
+    read-only, so the lookup cannot be changed by callers.
+    """
+    arrays = {
+        "vm_ids": par_df["vannmiljo_id"],
+        "vm_units": par_df["vannmiljo_unit"],
+        "vm_par_units": par_df["vannmiljo_id"] + "_" + par_df["vannmiljo_unit"],
+        "factors": factors,
+        "mins": par_df["min"],
+        "maxs": par_df["max"],
+    }
+    for name, values in arrays.items():
+        dtype = object if name.startswith("vm_") else float
+        arrays[name] = np.array(values, dtype=dtype)
+        arrays[name].flags.writeable = False
+
+    return ParLookup(index=pd.Index(keys), **arrays)
+
+
+def find_station_issues(df, stations):
+    """Identify samples with no station code, station codes in 'df' that are not in the
+    definitive station list, codes with more than one name and names with more than
+    one code. Uses a single pass over the unique (code, name) pairs in 'df', so the
+    cost does not depend on the number of stations.
+
+    Args:
+        df:       Dataframe of sumbitted water chemistry data
+        stations: StationLookups. Output from 'build_station_lookups'
+
+    Returns:
+        StationIssues tuple (missing_code_names, unknown_codes, multi_named_codes,
+        multi_coded_names):
+            missing_code_names: Sorted list of names used for samples with no code
+            unknown_codes:      Sorted list of codes not in the station list
+            multi_named_codes:  Dict mapping code to an array of names used for it
+            multi_coded_names:  Dict mapping name to an array of codes used for it
+    """
+    pairs = df[["vannmiljo_code", "station_name"]].drop_duplicates()
+    no_code = pairs["vannmiljo_code"].isna()
+    missing_code_names = sorted(pairs.loc[no_code, "station_name"].unique(), key=str)
+    codes = pairs.loc[~no_code, "vannmiljo_code"].unique()
+    unknown_codes = sorted(
+        (code for code in codes if code not in stations.codes), key=str
+    )
+
+    dups = pairs[pairs.duplicated("vannmiljo_code", keep=False)]
+    multi_named_codes = (
+        dups.groupby("vannmiljo_code", sort=False)["station_name"].unique().to_dict()
+    )
+    dups = pairs[pairs.duplicated("station_name", keep=False)]
+    multi_coded_names = (
+        dups.groupby("station_name", sort=False)["vannmiljo_code"].unique().to_dict()
+    )
+
+    return StationIssues(
+        missing_code_names, unknown_codes, multi_named_codes, multi_coded_names
+    )
+
+
+def _cols_present(df, cols):
+    """Return the columns in 'cols' that are present in 'df'. Used for optional
+    columns such as 'labreferanse', which are not read by every template reader.
+    """
+    return [col for col in cols if col in df.columns]
+
+
+@register_rule("numeric", "Checking for non-numeric data")
+def check_numeric(df, parsed, stations):
+    """Check that relevant columns in 'df' contain numeric data. LOD values
+    beginning with '<' are permitted.
+    """
+    details = []
+    for col in parsed.non_numeric.columns[parsed.non_numeric.any()]:
+        non_num_vals = df.loc[parsed.non_numeric[col], col].values
+        details.append(
+            f" * Column **{col}** contains non-numeric values: `{non_num_vals}`"
+        )
+
+    if len(details) == 0:
+        return {}
+
+    return {
+        "severity": "error",
+        "message": (
+            "The template contains non-numeric data (see above). Please fix these "
+            "issues and try again."
+        ),
+        "details": details,
+        "rows": df.index[parsed.non_numeric.any(axis="columns")],
+    }
+
+
+@register_rule("missing_parameters", "Checking for expected parameters")
+def check_missing_parameters(df, parsed, stations):
+    """Check that relevant columns in 'df' contain at least some data."""
+    details = [
+        f" * Column **{col}** does not contain any data."
+        for col in EXPECTED_COLS
+        if df[col].isnull().all()
+    ]
+
+    if len(details) == 0:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": "Some columns for expected parameters do not contain any data.",
+        "details": details,
+    }
+
+
+@register_rule("greater_than_zero", "Checking for negative and zero values")
+def check_greater_than_zero(df, parsed, stations):
+    """Check that relevant columns in 'df' contain values greater than zero."""
+    le_zero = parsed.values[GT_ZERO_COLS] <= 0
+    cols = le_zero.columns[le_zero.any()]
+
+    if len(cols) == 0:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": "Some measured values are less than or equal to zero.",
+        "details": [
+            f" * Column **{col}** contains values less than or equal to zero."
+            for col in cols
+        ],
+        "rows": df.index[le_zero.any(axis="columns")],
+    }
+
+
+@register_rule("lod_consistent", "Checking Limit of Detection (LOD) values")
+def check_lod_consistent(df, parsed, stations):
+    """Check that the LOD for each parameter in 'df' is consistent."""
+    details = []
+    bad_rows = pd.Series(False, index=df.index)
+    for col in parsed.lod.columns[parsed.lod.any()]:
+        lods = df.loc[parsed.lod[col], col].unique()
+        if len(lods) > 1:
+            details.append(
+                f" * Column **{col}** contains multiple LOD values: `{lods}`."
+            )
+            bad_rows |= parsed.lod[col]
+
+    if len(details) == 0:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": "Some columns have multiple/inconsistent LOD values.",
+        "details": details,
+        "rows": df.index[bad_rows],
+    }
+
+
+@register_rule("stations", "Checking stations")
+def check_stations(df, parsed, stations):
+    """Basic check of station data in 'df' against reference data in 'stations'."""
+    issues = find_station_issues(df, stations)
+    details = []
+    if len(issues.missing_code_names) > 0:
+        details.append("The following location names have samples with no location ID.")
+        details.append(f"```\n{set(issues.missing_code_names)}\n```")
+
+    if len(issues.unknown_codes) > 0:
+        details.append(
+            "The following location IDs are not in the definitive station list."
+        )
+        details.append(f"```\n{set(issues.unknown_codes)}\n```")
+
+    # Check station IDs have consistent names
+    if len(issues.multi_named_codes) > 0:
+        msg = ""
+        for site_id, names in issues.multi_named_codes.items():
+            true_name = stations.names.get(site_id)
+            msg += (
+                f"\n * Site `{site_id}` (`{true_name}`) has multiple names: `{names}`"
+            )
+        details.append(
+            "The following location IDs have inconsistent names within this template:"
+        )
+        details.append(msg)
+
+    # Check station names have consistent IDs
+    if len(issues.multi_coded_names) > 0:
+        msg = ""
+        for site_name, ids in issues.multi_coded_names.items():
+            true_ids = list(stations.name_codes.get(site_name, ()))
+            msg += f"\n * **{site_name}** (`{true_ids}`) has multiple IDs: `{ids}`"
+        details.append(
+            "The following location names have multiple IDs within this template:"
+        )
+        details.append(msg)
+
+    if len(details) == 0:
+        return {}
+
+    bad_rows = (
+        df["vannmiljo_code"].isna()
+        | df["vannmiljo_code"].isin(issues.unknown_codes)
+        | df["vannmiljo_code"].isin(list(issues.multi_named_codes))
+        | df["station_name"].isin(list(issues.multi_coded_names))
+    )
+
+    return {
+        "severity": "warning",
+        "message": (
+            "The template contains unknown or duplicated station names and/or IDs."
+        ),
+        "details": details,
+        "rows": df.index[bad_rows],
+    }
+
+
+@register_rule("quarter", "Checking sample dates")
+def check_quarter(df, parsed, stations):
+    """Check all samples come from the same year quarter."""
+    quarters = df["sample_date"].dt.quarter
+    if len(quarters.unique()) <= 1:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": (
+            "The file contains samples from several year quarters "
+            f"(quarters: `{quarters.unique()}`)."
+        ),
+        "rows": df.index[quarters != quarters.mode().iloc[0]],
+    }
+
+
+@register_rule("duplicates", "Checking duplicates")
+def check_duplicates(df, parsed, stations):
+    """Check for multiple samples at the same location, time and depth."""
+    cols = ID_COLS + _cols_present(df, ["labreferanse", "resultatkommentar"])
+    dup_df = duplicates.find_duplicates(df[cols], ID_COLS).sort_values(
+        ID_COLS, kind="stable"
+    )
+    n_dups = len(dup_df)
+    if n_dups == 0:
+        return {}
+
+    details = [f"There are **{n_dups}** duplicated samples."]
+    if "resultatkommentar" in dup_df.columns:
+        n_flood = duplicates.is_flood_sample(dup_df).sum()
+        details[0] += (
+            f"\nOf these, **{n_flood}** are marked as 'Flomprøve' in the "
+            "'resultatkommentar' column."
+        )
+
+    return {
+        "severity": "warning",
+        "message": "Possible duplicate samples identified.",
+        "details": details,
+        "tables": [("", dup_df)],
+        "rows": dup_df.index,
+    }
+
+
+@register_rule("no3_totn", "NO3 and TOTN", group="Checking water chemistry")
+def check_no3_totn(df, parsed, stations):
+    """Highlights all rows where nitrate > TOTN. Emphasises rows where
+    NO3 > TOTN and TOC > 5 based on advice from Øyvind G (see e-mail received
+    04.05.2022 at 23.23 for details).
+    """
+    num_cols = ["NO3_µg/l", "Tot-N_µg/l", "TOC_mg/l"]
+    mask_df = df[ID_COLS + num_cols + _cols_present(df, ["labreferanse"])].copy()
+    mask_df[num_cols] = parsed.values[num_cols].fillna(0)
+    mask = mask_df["NO3_µg/l"] > mask_df["Tot-N_µg/l"]
+    mask_df = mask_df[mask]
+    mask_df_toc = mask_df[mask_df["TOC_mg/l"] > 5]
+
+    if len(mask_df) == 0:
+        return {}
+
+    tables = [
+        (
+            "The following samples have nitrate greater than total nitrogen:",
+            mask_df,
+        )
+    ]
+    if len(mask_df_toc) > 0:
+        tables.append(
+            (
+                "Of these, the following samples have nitrate greater than total "
+                "nitrogen **and** TOC > 5 mg/l.\nThis is unlikely to be within "
+                "instrument error",
+                mask_df_toc,
+            )
+        )
+
+    return {
+        "severity": "warning",
+        "message": "Possible issues with NO3 and TOTN.",
+        "tables": tables,
+        "rows": mask_df.index,
+    }
+
+
+@register_rule("ral_ilal_lal", "Al fractions", group="Checking water chemistry")
+def check_ral_ilal_lal(df, parsed, stations):
+    """Check RAl - ILAl = LAl."""
+    num_cols = ["RAl_µg/l", "ILAl_µg/l", "LAl_µg/l"]
+    mask_df = df[ID_COLS + num_cols + _cols_present(df, ["labreferanse"])].copy()
+    mask_df.dropna(subset="LAl_µg/l", inplace=True)
+    mask_df[num_cols] = parsed.values.loc[mask_df.index, num_cols].fillna(0)
+    mask_df["LAl_Expected_µg/l"] = (mask_df["RAl_µg/l"] - mask_df["ILAl_µg/l"]).round(1)
+    mask_df["LAl_µg/l"] = mask_df["LAl_µg/l"].round(1)
+    mask = mask_df["LAl_Expected_µg/l"] != mask_df["LAl_µg/l"]
+    mask_df = mask_df[mask]
+
+    if len(mask_df) == 0:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": "Possible issues with the calculation of LAl.",
+        "tables": [
+            ("The following samples have LAl not equal to (RAl - ILAl):", mask_df)
+        ],
+        "rows": mask_df.index,
+    }
+
+
+@register_rule("lal_ph", "LAl and pH", group="Checking water chemistry")
+def check_lal_ph(df, parsed, stations):
+    """Highlight rows where pH > 6.4 and LAl > 20 ug/l. See e-mail from
+    Øyvind G received 04.05.2022 at 23.23 for background.
+    """
+    mask_df = df[
+        ID_COLS + ["pH_enh", "LAl_µg/l"] + _cols_present(df, ["labreferanse"])
+    ].copy()
+    mask_df["pH_enh"] = parsed.values["pH_enh"]
+    mask_df["LAl_µg/l"] = parsed.values["LAl_µg/l"].fillna(0)
+    mask_df = mask_df[(mask_df["pH_enh"] > 6.4) & (mask_df["LAl_µg/l"] > 20)]
+
+    if len(mask_df) == 0:
+        return {}
+
+    return {
+        "severity": "warning",
+        "message": "Possible issues with LAl and/or pH.",
+        "tables": [
+            (
+                "The following samples have LAl > 20 µg/l and pH > 6.4, which is "
+                "considered unlikely:",
+                mask_df,
+            )
+        ],
+        "rows": mask_df.index,
+    }
@@ -1,10 +1,43 @@
-import numpy as np
+import hashlib
+import io
+import os
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+
+import historic
 import pandas as pd
+import qc
 import streamlit as st
 
+# Reference datasets
+PAR_UNIT_XLSX = qc.PAR_UNIT_XLSX
+STATIONS_XLSX = qc.STATIONS_XLSX
+HISTORIC_BASELINE = historic.HISTORIC_BASELINE
+
+# Bounds for the cache of parsed templates and their check results, which is shared
+# by all sessions
+TEMPLATE_CACHE_MAX_ENTRIES = 32
+TEMPLATE_CACHE_MAX_BYTES = 256 * 1024**2
+
+# A parsed template in the cache. 'stages' maps a stage of the checks (see
+# '_cached_stage') to its result and 'stage_bytes' maps it to the result's size
+TemplateEntry = namedtuple(
+    "TemplateEntry", ["df", "missing_cols", "n_bytes", "stages", "stage_bytes"]
+)
+
+# LRU cache of parsed templates. Maps key => TemplateEntry
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
 
 def app():
-    """Main function for the 'check' page."""
+    """Main function for the 'check' page. The checks run as a series of stages
+    (parse, normalise, then one stage per rule), each cached with the parsed
+    template (see '_cached_stage'). After the first run for an upload, re-running
+    the page only redraws cached results, unless the lab or the reference data
+    change.
+    """
     lab = st.sidebar.selectbox("Select lab:", ["Eurofins", "VestfoldLAB"])
     data_file = st.sidebar.file_uploader("Upload data")
 
@@ -16,554 +49,379 @@ def app():
                 "(top-right of the table) to expand to full-screen."
             )
             st.markdown(f"**File name:** `{data_file.name}`")
-            df = read_data_template(data_file, sheet_name="results", lab=lab)
-            stn_df = pd.read_excel(
-                r"./data/all_stations_2025-11-13.xlsx", sheet_name="data"
+            key = get_template_key(data_file, sheet_name="results", lab=lab)
+            registry = get_par_registry()
+            df = read_data_template(
+                data_file, sheet_name="results", lab=lab, key=key, registry=registry
             )
-            st.dataframe(df.astype(str))
+            stations = get_stations()
+            parsed, display_df = _normalise_template(key, df)
+            st.dataframe(display_df)
 
         # Begin QC checks
-        check_numeric(df)
-        check_missing_parameters(df)
-        check_greater_than_zero(df)
-        check_lod_consistent(df)
-        check_stations(df, stn_df)
-        check_quarter(df)
-        check_duplicates(df)
-        st.header("Checking water chemistry")
-        check_no3_totn(df)
-        check_ral_ilal_lal(df)
-        check_lal_ph(df)
+        stations_mtime = os.path.getmtime(STATIONS_XLSX)
+        group = None
+        for rule in qc.RULES:
+            result = _run_rule(key, rule.name, stations_mtime, df, parsed, stations)
+            if result.group is None:
+                st.header(result.title)
+            else:
+                if result.group != group:
+                    st.header(result.group)
+                st.subheader(result.title)
+            group = result.group
+            render_result(result)
+
+            if result.severity == "error":
+                st.stop()
+
+        # Compare with historic data
+        baseline = get_historic_baseline()
+        st.header("Checking against historic data")
+        if baseline is None:
+            st.info("No historic baseline is available, so this check was skipped.")
+        else:
+            for result in _run_historic_checks(
+                key, _get_historic_baseline_mtime(), df, parsed, baseline, registry, lab
+            ):
+                st.subheader(result.title)
+                render_result(result)
 
     return None
 
 
-# @st.cache
-def get_par_unit_mappings():
-    """Get dataframe mapping parameters and units as reported by Vestfold Lab and Eurofins
-    to those used in Vannmiljø.
-
-    Args:
-        None
+def _normalise_template(key, df):
+    """Parse the numeric columns of a template and convert it to text for display.
+    Cached with the template 'key' (see 'get_template_key').
 
     Returns:
-        Dataframe.
+        Tuple (parsed, display_df).
     """
-    df = pd.read_excel(
-        r"./data/parameter_unit_mapping.xlsx",
-        sheet_name="to_vannmiljo",
-        keep_default_na=False,
+    return _cached_stage(
+        key, ("normalise",), lambda: (qc.parse_numeric(df), df.astype(str))
     )
 
-    return df
 
-
-# @st.cache
-def read_data_template(file_path, sheet_name="results", lab="Eurofins"):
-    """Read lab data from the agreed template in 'wide' format. An example of
-    the template is here:
-
-            ./data/vestfold_lab_data_to_2020-08-31.xls
-
-    Args:
-        file_path:  Raw str. Path to Excel template
-        sheet_name: Str. Name of sheet to read
-        lab:        Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+def _run_rule(key, rule_name, stations_mtime, df, parsed, stations):
+    """Apply a single QC rule to a template. Cached with the template 'key', on the
+    rule and the modification time of the station list.
 
     Returns:
-        Dataframe.
+        CheckResult.
     """
-    assert lab in [
-        "VestfoldLAB",
-        "Eurofins",
-    ], "'lab' must be one of ['VestfoldLAB', 'Eurofins']."
-
-    par_df = get_par_unit_mappings()
-    df = pd.read_excel(
-        file_path,
-        sheet_name=sheet_name,
-        skiprows=1,
-        usecols="C,D,F,G,I:AD",
-        header=None,
-    )
-
-    # Parse header
-    header = df[:2]
-    df = df[2:]
-    first = header.loc[1].tolist()[:4]
-    pars = header.loc[0].tolist()[4:]
-    units = header.loc[1].tolist()[4:]
-    pars_units = [f"{par}_{unit}" for par, unit in zip(pars, units)]
-    df.columns = first + pars_units
-
-    # Tidy
-    df.rename(
-        {
-            "Lokalitets-ID": "vannmiljo_code",
-            "Prøvested": "station_name",
-            "Prøvedato": "sample_date",
-            "Dybde": "depth1",
-            "nan_Labreferanse": "labreferanse",
-            "nan_Resultatkommentar": "resultatkommentar",
-        },
-        inplace=True,
-        axis="columns",
+    return _cached_stage(
+        key,
+        ("rule", rule_name, stations_mtime),
+        lambda: next(qc.run_checks(df, stations, parsed=parsed, rules=[rule_name])),
     )
-    df["depth1"].fillna(0, inplace=True)  # Assume depth is 0 unless otherwise stated
-    df["depth2"] = df["depth1"]  # Assume no mixed/integrated samples
-    df["sample_date"] = pd.to_datetime(df["sample_date"])
-
-    # Get pars of interest
-    cols = [
-        f"{par}_{unit}"
-        for par, unit in zip(
-            par_df[f"{lab.lower()}_name"], par_df[f"{lab.lower()}_unit"]
-        )
-    ]
-    n_errors = 0
-    for col in cols:
-        if col not in df.columns:
-            n_errors += 1
-            st.markdown(f" * Column **{col}** is missing from the data file provided.")
 
-    if n_errors > 0:
-        st.error(
-            "ERROR: The data file is missing some required parameters. Please use the "
-            "template available here:\n\n"
-            "https://github.com/NIVANorge/tiltaksovervakingen/blob/master/data/tiltaksovervakingen_blank_data_template.xlsx"
-        )
-        st.stop()
 
-    df = df[
-        ["vannmiljo_code", "station_name", "sample_date", "depth1", "depth2"]
-        + cols
-        + ["labreferanse", "resultatkommentar"]
-    ]
+def _run_historic_checks(key, baseline_mtime, df, parsed, baseline, registry, lab):
+    """Compare a template with the historic baseline. Cached with the template 'key'
+    (which includes the lab and the modification time of the parameter mappings), on
+    the modification time of the baseline.
 
-    return df
+    Returns:
+        List of CheckResult.
+    """
+    return _cached_stage(
+        key,
+        ("historic", baseline_mtime),
+        lambda: list(historic.run_historic_checks(df, parsed, baseline, registry, lab)),
+    )
 
 
-def check_numeric(df):
-    """Check that relevant columns in 'df' contain numeric data. LOD values
-    beginning with '<' are permitted.
+def _cached_stage(key, stage, func):
+    """Get the result of a stage of the checks for the template 'key', calling 'func'
+    if it is not already cached. Results are stored in the template's entry in
+    '_template_cache', so they count towards the same bounds and are evicted with
+    the template. They are shared by all sessions without copying, so must not be
+    modified. If the template is not cached (e.g. because it is too large), results
+    are not cached either.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        key:   Tuple. Output from 'get_template_key'
+        stage: Tuple. Identifies the stage and any other inputs it depends on
+        func:  Callable with no arguments, returning the result of the stage
 
     Returns:
-        None. Problems identified are printed to output. Raises a ValueError
-        if data cannot be parsed
+        Result of 'func'.
     """
-    st.header("Checking for non-numeric data")
-    non_num_cols = [
-        "vannmiljo_code",
-        "station_name",
-        "sample_date",
-        "labreferanse",
-        "resultatkommentar",
-    ]
-    num_cols = [col for col in df.columns if col not in non_num_cols]
-    n_errors = 0
-    for col in num_cols:
-        num_series = pd.to_numeric(
-            df[col].fillna(-9999).astype(str).str.strip("<").str.replace(",", "."),
-            errors="coerce",
-        )
-        non_num_vals = df[pd.isna(num_series)][col].values
-        if len(non_num_vals) > 0:
-            n_errors += 1
-            st.markdown(
-                f" * Column **{col}** contains non-numeric values: `{non_num_vals}`"
-            )
-
-    if n_errors > 0:
-        st.error(
-            "ERROR: The template contains non-numeric data (see above). Please fix these issues and try again."
-        )
-        st.stop()
-    else:
-        st.success("OK!")
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+        if (entry is not None) and (stage in entry.stages):
+            _template_cache.move_to_end(key)
+            return entry.stages[stage]
 
-    return None
+    result = func()
+    n_bytes = _n_bytes(result)
 
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+        if entry is not None:
+            entry.stages[stage] = result
+            entry.stage_bytes[stage] = n_bytes
+            _template_cache.move_to_end(key)
+            _evict_templates()
 
-def check_missing_parameters(df):
-    """Check that relevant columns in 'df' contain at least some data.
+    return result
 
-    Args:
-        df: Dataframe of sumbitted water chemistry data
 
-    Returns:
-        None. Problems identified are printed to output.
+def _n_bytes(value):
+    """Approximate memory used by a cached value, including the contents of
+    dataframes and of (named)tuples, lists and dicts.
     """
-    st.header("Checking for expected parameters")
-    col_list = [
-        "pH_enh",
-        "Kond_ms/m",
-        "Alk_mmol/l",
-        "Tot-P_µg/l",
-        "Tot-N_µg/l",
-        "NO3_µg/l",
-        "TOC_mg/l",
-        "RAl_µg/l",
-        "ILAl_µg/l",
-        "LAl_µg/l",
-        "Cl_mg/l",
-        "SO4_mg/l",
-        "Ca_mg/l",
-        "K_mg/l",
-        "Mg_mg/l",
-        "Na_mg/l",
-        "SIO2_µg/l",
-        "ANC_µekv/l",
-    ]
-    n_errors = 0
-    for col in col_list:
-        if df[col].isnull().all():
-            n_errors += 1
-            st.markdown(f" * Column **{col}** does not contain any data.")
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_n_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_n_bytes(item) for item in value.values())
 
-    if n_errors == 0:
-        st.success("OK!")
-    else:
-        st.warning(
-            "WARNING: Some columns for expected parameters do not contain any data."
-        )
-
-    return None
+    return sys.getsizeof(value)
 
 
-def check_greater_than_zero(df):
-    """Check that relevant columns in 'df' contain values greater than zero.
+def render_result(result):
+    """Display a QC result in the app.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        result: CheckResult. Output from 'qc.run_checks'
 
     Returns:
-        None. Problems identified are printed to output.
+        None.
     """
-    st.header("Checking for negative and zero values")
-    gt_zero_cols = [
-        "pH_enh",
-        "Kond_ms/m",
-        "Alk_mmol/l",
-        "Tot-P_µg/l",
-        "Tot-N_µg/l",
-        "NO3_µg/l",
-        "TOC_mg/l",
-        "RAl_µg/l",
-        "ILAl_µg/l",
-        "Cl_mg/l",
-        "SO4_mg/l",
-        "Ca_mg/l",
-        "K_mg/l",
-        "Mg_mg/l",
-        "Na_mg/l",
-        "SIO2_µg/l",
-    ]
-    n_errors = 0
-    for col in gt_zero_cols:
-        num_series = pd.to_numeric(
-            df[col].fillna(-9999).astype(str).str.strip("<").str.replace(",", ".")
-        )
-        num_series[num_series == -9999] = np.nan
-        if num_series.min() <= 0:
-            n_errors += 1
-            st.markdown(
-                f" * Column **{col}** contains values less than or equal to zero."
-            )
-
-    if n_errors == 0:
-        st.success("OK!")
+    for detail in result.details:
+        st.markdown(detail)
+    for caption, table in result.tables:
+        if caption:
+            st.markdown(caption)
+        st.dataframe(table)
+
+    if result.severity == "error":
+        st.error(f"ERROR: {result.message}")
+    elif result.severity == "warning":
+        st.warning(f"WARNING: {result.message}")
     else:
-        st.warning("WARNING: Some measured values are less than or equal to zero.")
+        st.success("OK!")
 
     return None
 
 
-def check_lod_consistent(df):
-    """Check that the LOD for each parameter in 'df' is consistent.
-
-    Args:
-        df: Dataframe of sumbitted water chemistry data
-
-    Returns:
-        None. Problems identified are printed to output.
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _read_par_registry(file_path, mtime):
+    """Cached reader for 'get_par_registry'. 'mtime' is only used as part of the
+    cache key, so that edits to the Excel file are picked up automatically.
     """
-    st.header("Checking Limit of Detection (LOD) values")
-    n_errors = 0
-    for col in df.columns:
-        lods = df[df[col].astype(str).str.contains("<")][col].unique()
-        if len(lods) > 1:
-            n_errors += 1
-            st.markdown(f" * Column **{col}** contains multiple LOD values: `{lods}`.")
-
-    if n_errors == 0:
-        st.success("OK!")
-    else:
-        st.warning("WARNING: Some columns have multiple/inconsistent LOD values.")
+    par_df = pd.read_excel(file_path, sheet_name="to_vannmiljo", keep_default_na=False)
 
-    return None
+    return qc.build_par_registry(par_df)
 
 
-def check_stations(df, stn_df):
-    """Basic check of station data in 'df' against reference data in 'stn_df'.
+def get_par_registry():
+    """Get the parameter mappings, with lookups for each lab (see
+    'qc.build_par_registry'). The Excel file is only parsed when it has been
+    modified since it was last read; the same registry is shared by all sessions.
 
     Args:
-        df:     Dataframe of sumbitted water chemistry data
-        stn_df: Dataframe of reference station details
+        None
 
     Returns:
-        None. Problems identified are printed to output.
+        qc.ParRegistry. Treat as read-only: it is not copied for each caller.
     """
-    st.header("Checking stations")
-    n_errors = 0
-    if not set(df["vannmiljo_code"]).issubset(set(stn_df["vannmiljo_code"])):
-        n_errors += 1
-        st.markdown(
-            "The following location IDs are not in the definitive station list."
-        )
-        st.code(set(df["vannmiljo_code"]) - set(stn_df["vannmiljo_code"]))
+    return _read_par_registry(PAR_UNIT_XLSX, os.path.getmtime(PAR_UNIT_XLSX))
 
-    # Check station IDs have consistent names
-    msg = ""
-    site_ids = df["vannmiljo_code"].unique()
-    for site_id in site_ids:
-        true_name = stn_df.query("vannmiljo_code == @site_id")["station_name"].values
-        names = df.query("vannmiljo_code == @site_id")["station_name"].unique()
 
-        if len(names) > 1:
-            msg += f"\n * Site `{site_id}` (`{true_name[0]}`) has multiple names: `{names}`"
+@st.cache_data(show_spinner=False)
+def _read_stations(file_path, mtime):
+    """Cached reader for 'get_stations'."""
+    stn_df = pd.read_excel(file_path, sheet_name="data")
 
-        # if true_name[0] not in names:
-        #     msg += f"\n * Name for site ID `{site_id}` should be `{true_name[0]}`"
+    return qc.build_station_lookups(stn_df)
 
-    if msg != "":
-        n_errors += 1
-        st.markdown(
-            "The following location IDs have inconsistent names within this template:"
-        )
-        st.markdown(msg)
 
-    # Check station names have consistent IDs
-    msg = ""
-    site_names = df["station_name"].unique()
-    for site_name in site_names:
-        true_id = stn_df.query("station_name == @site_name")["vannmiljo_code"].values
-        ids = df.query("station_name == @site_name")["vannmiljo_code"].unique()
+def get_stations():
+    """Get the definitive station list, together with precomputed lookups. The Excel
+    file is only parsed when it has been modified since it was last read; the result
+    is shared by all sessions.
 
-        if len(ids) > 1:
-            msg += f"\n * **{site_name}** has multiple IDs: `{ids}`"
+    Args:
+        None
 
-        # if true_id[0] not in ids:
-        #     msg += f"\n * Site ID for `{site_name}` should be `{true_id[0]}`"
+    Returns:
+        StationLookups tuple. See 'qc.build_station_lookups'.
+    """
+    return _read_stations(STATIONS_XLSX, os.path.getmtime(STATIONS_XLSX))
 
-    if msg != "":
-        n_errors += 1
-        st.markdown(
-            "The following location names have multiple IDs within this template:"
-        )
-        st.markdown(msg)
 
-    if n_errors == 0:
-        st.success("OK!")
-    else:
-        st.warning(
-            "WARNING: The template contains unknown or duplicated station names and/or IDs."
-        )
+@st.cache_data(show_spinner=False)
+def _read_historic_baseline(dir_path, mtime):
+    """Cached reader for 'get_historic_baseline'."""
+    return historic.read_baseline(dir_path)
 
-    return None
 
+def _get_historic_baseline_mtime():
+    """Latest modification time of the historic baseline files, or None if any of
+    them are missing.
+    """
+    paths = [
+        os.path.join(HISTORIC_BASELINE, f"{name}.parquet")
+        for name in historic.Baseline._fields
+    ]
+    if not all(os.path.exists(path) for path in paths):
+        return None
 
-def check_quarter(df):
-    """Check all samples come from the same year quarter.
+    return max(os.path.getmtime(path) for path in paths)
+
+
+def get_historic_baseline():
+    """Get the precomputed summary of the historic data. The files are only read when
+    they have been modified since they were last read; the result is shared by all
+    sessions.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        None
 
     Returns:
-        None. Problems identified are printed to output.
+        historic.Baseline, or None if the baseline does not exist.
     """
-    st.header("Checking sample dates")
-    quarters = df["sample_date"].dt.quarter
-    if len(quarters.unique()) > 1:
-        st.warning(
-            f"WARNING: The file contains samples from several year quarters (quarters: `{quarters.unique()}`)."
-        )
-    else:
-        st.success("OK!")
+    mtime = _get_historic_baseline_mtime()
+    if mtime is None:
+        return None
 
-    return None
+    return _read_historic_baseline(HISTORIC_BASELINE, mtime)
 
 
-def check_no3_totn(df):
-    """Highlights all rows where nitrate > TOTN. Emphasises rows where
-    NO3 > TOTN and TOC > 5 based on advice from Øyvind G (see e-mail received
-    04.05.2022 at 23.23 for details).
+def get_template_key(file_path, sheet_name="results", lab="Eurofins"):
+    """Get the key identifying a parsed template in the caches. This combines a hash
+    of the file contents with the lab, the sheet and the modification time of the
+    parameter mappings, so any change to these invalidates every stage.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        file_path:  Raw str or file-like. Path to Excel template, or uploaded file
+        sheet_name: Str. Name of sheet to read
+        lab:        Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
 
     Returns:
-        None. Problems identified are printed to output.
+        Tuple.
     """
-    st.subheader("NO3 and TOTN")
-    mask_df = df[
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "depth1",
-            "depth2",
-            "NO3_µg/l",
-            "Tot-N_µg/l",
-            "TOC_mg/l",
-            "labreferanse",
-        ]
-    ].copy()
-
-    for col in ["NO3_µg/l", "Tot-N_µg/l", "TOC_mg/l"]:
-        mask_df[col].fillna(0, inplace=True)
-        mask_df[col] = pd.to_numeric(
-            mask_df[col].astype(str).str.strip("<").str.replace(",", ".")
-        )
-    mask = mask_df["NO3_µg/l"] > mask_df["Tot-N_µg/l"]
-    mask_df = mask_df[mask]
-    mask_df_toc = mask_df[mask_df["TOC_mg/l"] > 5]
-
-    if len(mask_df) > 0:
-        st.markdown("The following samples have nitrate greater than total nitrogen:")
-        st.dataframe(mask_df)
-
-    if len(mask_df_toc) > 0:
-        st.markdown(
-            "Of these, the following samples have nitrate greater than total nitrogen **and** TOC > 5 mg/l.\n"
-            "This is unlikely to be within instrument error"
-        )
-        st.dataframe(mask_df_toc)
+    key = (
+        hashlib.sha256(_read_bytes(file_path)).hexdigest(),
+        lab,
+        sheet_name,
+        os.path.getmtime(PAR_UNIT_XLSX),
+    )
 
-    if len(mask_df) > 0:
-        st.warning(f"WARNING: Possible issues with NO3 and TOTN.")
-    else:
-        st.success("OK!")
+    return key
+
+
+def _read_bytes(file_path):
+    """Contents of an uploaded file or a file on disk."""
+    if hasattr(file_path, "getvalue"):
+        return file_path.getvalue()
+
+    with open(file_path, "rb") as f:
+        return f.read()
 
-    return None
 
+def read_data_template(
+    file_path, sheet_name="results", lab="Eurofins", key=None, registry=None
+):
+    """Read lab data from the agreed template in 'wide' format. An example of
+    the template is here:
+
+            ./data/vestfold_lab_data_to_2020-08-31.xls
 
-def check_ral_ilal_lal(df):
-    """Check RAl - ILAl = LAl.
+    Parsed templates are cached using a hash of the file contents, so re-running
+    the page with the same upload does not parse the workbook again.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        file_path:  Raw str or file-like. Path to Excel template, or uploaded file
+        sheet_name: Str. Name of sheet to read
+        lab:        Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+        key:        Tuple or None. Output from 'get_template_key', if already known
+        registry:   ParRegistry or None. Parameter mappings. If None, uses
+                    'get_par_registry'
 
     Returns:
-        None. Problems identified are printed to output.
+        Dataframe.
     """
-    st.subheader("Al fractions")
-    mask_df = df[
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "depth1",
-            "depth2",
-            "RAl_µg/l",
-            "ILAl_µg/l",
-            "LAl_µg/l",
-            "labreferanse",
-        ]
-    ].copy()
-    mask_df.dropna(subset="LAl_µg/l", inplace=True)
-
-    for col in ["RAl_µg/l", "ILAl_µg/l", "LAl_µg/l"]:
-        mask_df[col].fillna(0, inplace=True)
-        mask_df[col] = pd.to_numeric(
-            mask_df[col].astype(str).str.strip("<").str.replace(",", ".")
+    assert lab in [
+        "VestfoldLAB",
+        "Eurofins",
+    ], "'lab' must be one of ['VestfoldLAB', 'Eurofins']."
+
+    if key is None:
+        key = get_template_key(file_path, sheet_name=sheet_name, lab=lab)
+    if registry is None:
+        registry = get_par_registry()
+    with _template_cache_lock:
+        entry = _template_cache.get(key)
+        if entry is not None:
+            _template_cache.move_to_end(key)
+    if entry is None:
+        df, missing_cols = qc.parse_data_template(
+            io.BytesIO(_read_bytes(file_path)),
+            list(registry.labs[lab].index),
+            sheet_name=sheet_name,
         )
-    mask_df["LAl_Expected_µg/l"] = (mask_df["RAl_µg/l"] - mask_df["ILAl_µg/l"]).round(1)
-    mask_df["LAl_µg/l"] = mask_df["LAl_µg/l"].round(1)
-    mask = mask_df["LAl_Expected_µg/l"] != mask_df["LAl_µg/l"]
-    mask_df = mask_df[mask]
-
-    if len(mask_df) > 0:
-        st.markdown("The following samples have LAl not equal to (RAl - ILAl):")
-        st.dataframe(mask_df)
-        st.warning(f"WARNING: Possible issues with the calculation of LAl.")
-    else:
-        st.success("OK!")
+        entry = _cache_template(key, df, missing_cols)
+    df, missing_cols = entry.df, entry.missing_cols
 
-    return None
+    for col in missing_cols:
+        st.markdown(f" * Column **{col}** is missing from the data file provided.")
+
+    if len(missing_cols) > 0:
+        st.error(
+            "ERROR: The data file is missing some required parameters. Please use the "
+            "template available here:\n\n"
+            "https://github.com/NIVANorge/tiltaksovervakingen/blob/master/data/tiltaksovervakingen_blank_data_template.xlsx"
+        )
+        st.stop()
 
+    return df.copy()
 
-def check_lal_ph(df):
-    """Highlight rows where pH > 6.4 and LAl > 20 ug/l. See e-mail from
-    Øyvind G received 04.05.2022 at 23.23 for background.
+
+def _cache_template(key, df, missing_cols):
+    """Add a parsed template to the LRU cache, evicting the least recently used
+    entries until the cache is within TEMPLATE_CACHE_MAX_ENTRIES and
+    TEMPLATE_CACHE_MAX_BYTES.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        key:          Tuple. Cache key
+        df:           Dataframe or None. Parsed template
+        missing_cols: List of str. Required columns missing from the template
 
     Returns:
-        None. Problems identified are printed to output.
+        TemplateEntry stored in the cache.
     """
-    st.subheader("LAl and pH")
-    mask_df = df[
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "depth1",
-            "depth2",
-            "pH_enh",
-            "LAl_µg/l",
-            "labreferanse",
-        ]
-    ].copy()
-    mask_df["LAl_µg/l"].fillna(0, inplace=True)
-    mask_df["LAl_µg/l"] = pd.to_numeric(
-        mask_df["LAl_µg/l"].astype(str).str.strip("<").str.replace(",", ".")
-    )
-    mask_df = mask_df[(mask_df["pH_enh"] > 6.4) & (mask_df["LAl_µg/l"] > 20)]
-    if len(mask_df) > 0:
-        st.markdown(
-            "The following samples have LAl > 20 µg/l and pH > 6.4, which is considered unlikely:"
-        )
-        st.dataframe(mask_df)
-        st.warning(f"WARNING: Possible issues with LAl and/or pH.")
-    else:
-        st.success("OK!")
-
-    return None
+    n_bytes = 0 if df is None else _n_bytes(df)
+    entry = TemplateEntry(df, missing_cols, n_bytes, {}, {})
+    if n_bytes > TEMPLATE_CACHE_MAX_BYTES:
+        return entry
 
+    with _template_cache_lock:
+        _template_cache[key] = entry
+        _template_cache.move_to_end(key)
+        _evict_templates()
 
-def check_duplicates(df):
-    """Check for multiple samples at the same location, time and depth.
+    return entry
 
-    Args:
-        df: Dataframe of sumbitted water chemistry data
 
-    Returns:
-        None. Problems identified are printed to output.
+def _evict_templates():
+    """Remove the least recently used templates, with their check results, until the
+    cache is within TEMPLATE_CACHE_MAX_ENTRIES and TEMPLATE_CACHE_MAX_BYTES. Must be
+    called while holding '_template_cache_lock'.
     """
-    st.header("Checking duplicates")
-    key_cols = [
-        "vannmiljo_code",
-        "sample_date",
-        "depth1",
-        "depth2",
-    ]
-    dup_df = df[
-        df.duplicated(
-            key_cols,
-            keep=False,
-        )
-    ].sort_values(key_cols)
-
-    dup_df = dup_df[key_cols + ["labreferanse", "resultatkommentar"]]
-    n_dups = len(dup_df)
-    n_flood = dup_df["resultatkommentar"].str.contains("Flomprøve").sum()
-    if n_dups > 0:
-        st.markdown(
-            f"There are **{n_dups}** duplicated samples.\n"
-            f"Of these, **{n_flood}** are marked as 'Flomprøve' in the 'resultatkommentar' column."
-        )
-        st.dataframe(dup_df)
-        st.warning(f"WARNING: Possible duplicate samples identified.")
-    else:
-        st.success("OK!")
+    total_bytes = sum(
+        entry.n_bytes + sum(entry.stage_bytes.values())
+        for entry in _template_cache.values()
+    )
+    while (len(_template_cache) > TEMPLATE_CACHE_MAX_ENTRIES) or (
+        total_bytes > TEMPLATE_CACHE_MAX_BYTES
+    ):
+        old_key, old_entry = _template_cache.popitem(last=False)
+        total_bytes -= old_entry.n_bytes + sum(old_entry.stage_bytes.values())
+
+    return None
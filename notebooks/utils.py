@@ -1,17 +1,75 @@
+import hashlib
 import os
+import shutil
 import sqlite3
+import sys
 import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
+import joblib
 import numpy as np
 import pandas as pd
+import sklearn
+from openpyxl import load_workbook
+from openpyxl.styles import Alignment, Font, PatternFill
+from pandas.api.types import union_categoricals
 from sklearn.ensemble import IsolationForest
 
+# QC rules, duplicate handling and comparisons with historic data are shared with
+# the Streamlit app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import duplicates
+import historic
+import qc
+
 pd.set_option("future.no_silent_downcasting", True)
 
+# Mappings from lab parameters and units to those used in Vannmiljø
+PAR_UNIT_XLSX = r"../../data/parameter_unit_mapping.xlsx"
+
+# Database holding the historic baseline once, plus the new data for each quarter
+MASTER_DB = r"../../output/kalk_master.db"
+
+# Compact summary of the historic data used by the Streamlit app
+HISTORIC_BASELINE = r"../../data/historic_baseline"
+
+# Isolation Forest models fitted to the historic data, named by a fingerprint of the
+# training data (see 'fit_isolation_forests')
+ISOFOREST_MODELS = r"../../output/isoforest_models"
+
+# An Isolation Forest fitted to the historic data for one set of parameters
+IsoForestModel = namedtuple("IsoForestModel", "name par_cols fingerprint model")
+
+# Sample details in 'wide' format water chemistry data. All other columns hold values
+# for a parameter, named '<par>_<unit>' as used by the lab
+WIDE_ID_COLS = ["vannmiljo_code", "station_name", "sample_date", "depth1", "depth2"]
+
+# Columns in 'long' format water chemistry data that are stored as categories, so
+# each row holds a small integer code rather than a Python string
+LONG_CAT_COLS = [
+    "vannmiljo_code",
+    "lab",
+    "par_unit",
+    "parameter",
+    "unit",
+    "flag",
+    "period",
+]
+
+# Secondary indexes on 'water_chemistry' in the master database. Rebuilt after bulk
+# loads
+WC_INDEXES = {
+    "wc_station_parameter_idx": "station_id, parameter_id",
+    "wc_parameter_idx": "parameter_id",
+}
+
 
 def get_par_unit_mappings():
     """Get dataframe mapping parameters and units as reported by Vestfold Lab and Eurofins
-    to those used in Vannmiljø.
+    to those used in Vannmiljø. This is a copy of the mappings held by
+    'get_par_registry', so it can be modified freely.
 
     Args:
         None
@@ -19,13 +77,33 @@ def get_par_unit_mappings():
     Returns:
         Dataframe.
     """
-    df = pd.read_excel(
-        r"../../data/parameter_unit_mapping.xlsx",
-        sheet_name="to_vannmiljo",
-        keep_default_na=False,
-    )
+    return get_par_registry().par_df.copy()
 
-    return df
+
+def get_par_registry(file_path=PAR_UNIT_XLSX):
+    """Get the parameter mappings, with lookups for each lab (see
+    'qc.build_par_registry'). The Excel file is only parsed when it has been
+    modified since it was last read, so this is cheap to call repeatedly.
+
+    Args:
+        file_path: Raw str. Path to 'parameter_unit_mapping.xlsx'
+
+    Returns:
+        qc.ParRegistry. Treat as read-only: it is shared by all callers.
+    """
+    file_path = os.path.abspath(file_path)
+
+    return _read_par_registry(file_path, os.path.getmtime(file_path))
+
+
+@lru_cache(maxsize=4)
+def _read_par_registry(file_path, mtime):
+    """Cached reader for 'get_par_registry'. 'mtime' is only used as part of the
+    cache key, so that edits to the Excel file are picked up automatically.
+    """
+    par_df = pd.read_excel(file_path, sheet_name="to_vannmiljo", keep_default_na=False)
+
+    return qc.build_par_registry(par_df)
 
 
 def read_data_template_to_wide(file_path, sheet_name="Ark1", lab="VestfoldLAB"):
@@ -47,46 +125,12 @@ def read_data_template_to_wide(file_path, sheet_name="Ark1", lab="VestfoldLAB"):
         "Eurofins",
     ], "'lab' must be one of ['VestfoldLAB', 'Eurofins']."
 
-    par_df = get_par_unit_mappings()
-    df = pd.read_excel(
-        file_path,
-        sheet_name=sheet_name,
-        skiprows=1,
-        usecols="C,D,F,G,I:AB",
-        header=None,
-    )
-
-    # Parse header
-    header = df[:2]
-    df = df[2:]
-    first = header.loc[1].tolist()[:4]
-    pars = header.loc[0].tolist()[4:]
-    units = header.loc[1].tolist()[4:]
-    pars_units = [f"{par}_{unit}" for par, unit in zip(pars, units)]
-    df.columns = first + pars_units
-
-    # Tidy
-    df.rename(
-        {
-            "Lokalitets-ID": "vannmiljo_code",
-            "Prøvested": "station_name",
-            "Prøvedato": "sample_date",
-            "Dybde": "depth1",
-        },
-        inplace=True,
-        axis="columns",
-    )
-    df["depth1"] = df["depth1"].fillna(0)  # Assume depth is 0 unless otherwise stated
-    df["depth2"] = df["depth1"]  # Assume no mixed/integrated samples
-    df["sample_date"] = pd.to_datetime(df["sample_date"], format="%Y-%m-%d %H:%M:%S")
+    cols = list(get_par_registry().labs[lab].index)
+    df, missing_cols = qc.parse_data_template(file_path, cols, sheet_name=sheet_name)
+    if len(missing_cols) > 0:
+        raise ValueError(f"The template is missing columns: {missing_cols}.")
 
     # Get pars of interest
-    cols = [
-        f"{par}_{unit}"
-        for par, unit in zip(
-            par_df[f"{lab.lower()}_name"], par_df[f"{lab.lower()}_unit"]
-        )
-    ]
     df = df[
         ["vannmiljo_code", "station_name", "sample_date", "depth1", "depth2"] + cols
     ]
@@ -95,508 +139,449 @@ def read_data_template_to_wide(file_path, sheet_name="Ark1", lab="VestfoldLAB"):
 
 
 def perform_basic_checks(df, stn_xls):
-    """Perform basic checks using 'wide' template data.
+    """Perform basic checks using 'wide' template data. Applies the same rules as
+    the Streamlit app (see '../app/qc.py').
 
     Args:
         df: Dataframe of tidied template data in 'wide' format
         stn_xls: Str. Path to Excel file with valid stations
 
     Returns:
-        None. Possible issues are printed to output.
+        List of qc.CheckResult. Possible issues are printed to output. Raises a
+        ValueError if data cannot be parsed.
     """
     stn_df = pd.read_excel(stn_xls, sheet_name="data")
+    stations = qc.build_station_lookups(stn_df)
 
-    check_stations(df, stn_df)
-    check_quarter(df)
-    check_numeric(df)
-    check_greater_than_zero(df)
-    check_lod_consistent(df)
-    check_no3_totn(df)
-    check_ral_ilal_lal(df)
+    results = []
+    for result in qc.run_checks(df, stations):
+        print(qc.format_result(result))
+        results.append(result)
 
-    return None
+        if result.severity == "error":
+            raise ValueError(result.message)
 
+    return results
 
-def wide_to_long(df, lab):
+
+def wide_to_long(df, lab, chunk_size=50000):
     """Converts 'wide' format data to 'long' format, including parsing of LOD
-    flags and conversion of units to match Vannmiljø.
+    flags and conversion of units to match Vannmiljø. Stations, labs, parameters,
+    units and flags are returned as categories (see 'LONG_CAT_COLS'). The Vannmiljø
+    '<par>_<unit>' is also returned as 'par_unit', as used by earlier notebooks.
+
+    Values and LOD flags are parsed column by column on the wide data (see
+    'qc.parse_numeric') and scaled by a vector of conversion factors, one per
+    column. Only the values present are then gathered into 'long' format. Rows are
+    processed 'chunk_size' at a time, so text is never parsed for the whole dataset
+    at once. Records are ordered by sample, then parameter.
 
     Args:
-        df:     Dataframe of tidied 'wide' format water chemistry data
-        lab:    Str. Name of lab submitting data
+        df:         Dataframe of tidied 'wide' format water chemistry data
+        lab:        Str. Name of lab submitting data
+        chunk_size: Int. Number of rows of 'df' to parse at a time
 
     Returns:
         Dataframe.
     """
-    par_df = get_par_unit_mappings()
-
-    del df["station_name"]
-    df = pd.melt(
-        df,
-        id_vars=["vannmiljo_code", "sample_date", "depth1", "depth2"],
-        var_name="par_unit",
-    )
-    df.dropna(subset=["value"], inplace=True)
-    df["flag"] = np.where(df["value"].astype(str).str.contains("<"), "<", "")
-    df["value"] = pd.to_numeric(
-        df["value"].astype(str).str.strip("<").str.replace(",", ".")
-    )
-    df["lab"] = lab
-
-    df = convert_units_to_vannmiljo(df, par_df, lab)
-
-    df = df[
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "lab",
-            "depth1",
-            "depth2",
-            "vm_par_unit",
-            "flag",
-            "value",
-        ]
+    lookup = get_par_registry().labs[lab]
+    par_cols = [col for col in df.columns if col not in WIDE_ID_COLS]
+    par_idx = lookup.index.get_indexer(par_cols)
+    missing = [col for col, idx in zip(par_cols, par_idx) if idx < 0]
+    assert len(missing) == 0, f"No Vannmiljø parameters for columns: {missing}."
+    factors = lookup.factors[par_idx]
+
+    # Positions in 'df' and 'par_cols' of each value present, plus values and flags
+    rows, cols, values, lod = [], [], [], []
+    for start in range(0, len(df), chunk_size):
+        parsed = qc.parse_numeric(df.iloc[start : start + chunk_size][par_cols])
+        if parsed.non_numeric.to_numpy().any():
+            raise ValueError("Dataframe contains values that cannot be parsed.")
+        chunk_values = parsed.values.to_numpy() * factors
+        chunk_rows, chunk_cols = np.nonzero(~np.isnan(chunk_values))
+        rows.append(chunk_rows + start)
+        cols.append(chunk_cols)
+        values.append(chunk_values[chunk_rows, chunk_cols])
+        lod.append(parsed.lod.to_numpy()[chunk_rows, chunk_cols])
+    rows, cols, values, lod = [
+        np.concatenate(arrs) if len(arrs) > 0 else np.array([], dtype=int)
+        for arrs in (rows, cols, values, lod)
     ]
 
-    df.rename({"vm_par_unit": "par_unit"}, inplace=True, axis="columns")
-
-    assert pd.isna(df).sum().sum() == 0, "Dataframe contains missing values."
-
-    df = df.astype(
+    stations = df["vannmiljo_code"].astype("category")
+    long_df = pd.DataFrame(
         {
-            "vannmiljo_code": "str",
-            "sample_date": "datetime64[ns]",
-            "lab": "str",
-            "depth1": "float",
-            "depth2": "float",
-            "par_unit": "str",
-            "flag": "str",
-            "value": "float",
+            "vannmiljo_code": stations.array.take(rows),
+            "sample_date": df["sample_date"].to_numpy(dtype="datetime64[ns]")[rows],
+            "lab": pd.Categorical.from_codes(np.zeros(len(rows), dtype=int), [lab]),
+            "depth1": df["depth1"].to_numpy(dtype=float)[rows],
+            "depth2": df["depth2"].to_numpy(dtype=float)[rows],
+            "par_unit": _categorical_from_labels(lookup.vm_par_units[par_idx], cols),
+            "parameter": _categorical_from_labels(lookup.vm_ids[par_idx], cols),
+            "unit": _categorical_from_labels(lookup.vm_units[par_idx], cols),
+            "flag": _categorical_from_labels(["", "<"], lod.astype(int)),
+            "value": values.astype(float),
         }
     )
+    long_df["vannmiljo_code"] = long_df["vannmiljo_code"].cat.remove_unused_categories()
 
-    return df
+    assert pd.isna(long_df).sum().sum() == 0, "Dataframe contains missing values."
 
+    return long_df
 
-def check_numeric(df):
-    """Check that relevant columns in 'df' contain numeric data. LOD values
-    beginning with '<' are permitted.
+
+def convert_units_to_vannmiljo(df, par_df, lab):
+    """Convert to VM par names and units. Each distinct 'par_unit' is looked up once
+    (see 'qc.build_par_registry'); neither 'df' nor 'par_df' is modified.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        df:     Dataframe of sumbitted water chemistry data, with columns 'par_unit'
+                and 'value'
+        par_df: Dataframe of reference parameters, or None to use the mappings from
+                'get_par_registry'
+        lab:    Str. Name of lab submitting data
 
     Returns:
-        None. Problems identified are printed to output. Raises a ValueError
-        if data cannot be parsed
-    """
-    print("\nChecking for non-numeric data:")
-    non_num_cols = ["vannmiljo_code", "station_name", "sample_date"]
-    num_cols = [col for col in df.columns if col not in non_num_cols]
-    n_errors = 0
-    for col in num_cols:
-        num_series = pd.to_numeric(
-            df[col]
-            .fillna(-9999)
-            .infer_objects(copy=False)
-            .astype(str)
-            .str.strip("<")
-            .str.replace(",", "."),
-            errors="coerce",
-        )
-        non_num_vals = df[pd.isna(num_series)][col].values
-        if len(non_num_vals) > 0:
-            n_errors += 1
-            print(f"    {col} contains non-numeric values: {non_num_vals}")
-
-    if n_errors > 0:
-        raise ValueError(
-            "The template contains non-numeric data (see above). Please fix these issues before continuing."
-        )
+        Dataframe in converted units, with the Vannmiljø parameter and unit as
+        categories in columns 'parameter' and 'unit'. These are missing for values
+        of 'par_unit' without a mapping.
+    """
+    if par_df is None:
+        lookup = get_par_registry().labs[lab]
     else:
-        print("    Done.")
+        lookup = qc.build_par_registry(par_df, labs=(lab,)).labs[lab]
+    par_idx = _lookup_positions(df["par_unit"], lookup.index)
+
+    # Index -1 (unknown 'par_unit') picks the trailing NaN
+    factors = np.append(lookup.factors, np.nan)[par_idx]
+    df = df.assign(
+        value=df["value"].to_numpy(dtype=float) * factors,
+        parameter=_categorical_from_labels(lookup.vm_ids, par_idx),
+        unit=_categorical_from_labels(lookup.vm_units, par_idx),
+    )
 
-    return None
+    return df
 
 
-def check_greater_than_zero(df):
-    """Check that relevant columns in 'df' contain values greater than zero.
+def _lookup_positions(ser, index):
+    """Positions in 'index' of each value in 'ser', or -1 where not found. Values are
+    looked up once per category.
+    """
+    ser = ser.astype("category")
+    codes = ser.cat.codes.to_numpy()
+    positions = index.get_indexer(ser.cat.categories)
 
-    Args:
-        df: Dataframe of sumbitted water chemistry data
+    return np.where(codes >= 0, positions[codes], -1)
 
-    Returns:
-        None. Problems identified are printed to output.
-    """
-    print("\nChecking for values less than zero:")
-    gt_zero_cols = [
-        "pH_enh",
-        "Kond_ms/m",
-        "Alk_mmol/l",
-        "Tot-P_µg/l",
-        "Tot-N_µg/l",
-        "NO3_µg/l",
-        "TOC_mg/l",
-        "RAl_µg/l",
-        "ILAl_µg/l",
-        "Cl_mg/l",
-        "SO4_mg/l",
-        "Ca_mg/l",
-        "K_mg/l",
-        "Mg_mg/l",
-        "Na_mg/l",
-        "SIO2_µg/l",
-    ]
-    n_errors = 0
-    for col in gt_zero_cols:
-        num_series = pd.to_numeric(
-            df[col]
-            .fillna(-9999)
-            .infer_objects(copy=False)
-            .astype(str)
-            .str.strip("<")
-            .str.replace(",", ".")
-        )
-        num_series[num_series == -9999] = np.nan
-        if num_series.min() <= 0:
-            n_errors += 1
-            print(f"    {col} contains values less than or equal to zero.")
 
-    if n_errors == 0:
-        print("    Done.")
+def _categorical_from_labels(labels, codes):
+    """Categorical built from 'codes' into 'labels', where 'labels' may contain
+    repeated values. Repeated labels are merged into a single category. Codes of -1
+    are missing.
+    """
+    categories, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    codes = np.asarray(codes)
+    codes = np.where(codes >= 0, inverse[codes], -1)
 
-    return None
+    return pd.Categorical.from_codes(codes, categories=categories)
 
 
-def check_lod_consistent(df):
-    """Check that the LOD for each parameter in 'df' is consistent.
+def recode_categories(ser, mapping):
+    """Replace values in a categorical column using 'mapping'. Only the categories
+    are changed, so this is cheap however many rows there are. Values mapped to an
+    existing category are merged with it.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        ser:     Series. Categorical column
+        mapping: Dict. Old values to new values. Values not in 'mapping' are kept
 
     Returns:
-        None. Problems identified are printed to output.
+        Series.
     """
-    print("\nChecking for consistent LOD values:")
-    n_errors = 0
-    for col in df.columns:
-        lods = df[df[col].astype(str).str.contains("<")][col].unique()
-        if len(lods) > 1:
-            n_errors += 1
-            print(f"    {col} contains multiple LOD values: {lods}.")
+    ser = ser.astype("category")
+    labels = [mapping.get(cat, cat) for cat in ser.cat.categories]
 
-    if n_errors == 0:
-        print("    Done.")
-
-    return None
+    return pd.Series(
+        _categorical_from_labels(labels, ser.cat.codes),
+        index=ser.index,
+        name=ser.name,
+    )
 
 
-def check_stations(df, stn_df):
-    """Basic check of station data in 'df' against reference data in 'stn_df'.
+def split_par_unit(ser):
+    """Split '<par>_<unit>' values into separate categorical parameter and unit
+    columns. Only the categories are split, not every row.
 
     Args:
-        df:     Dataframe of sumbitted water chemistry data
-        stn_df: Dataframe of reference station details
+        ser: Series. '<par>_<unit>' values, ideally already categorical
 
     Returns:
-        None. Problems identified are printed to output.
+        Tuple of Series (parameter, unit).
     """
-    print("\nChecking stations:")
-    if not set(df["vannmiljo_code"]).issubset(set(stn_df["vannmiljo_code"])):
-        print(
-            "The following location IDs in the new data are not in the definitive station list."
+    ser = ser.astype("category")
+    parts = ser.cat.categories.str.split("_", n=1)
+    codes = ser.cat.codes.to_numpy()
+
+    return tuple(
+        pd.Series(
+            _categorical_from_labels(parts.str[idx], codes), index=ser.index, name=name
         )
-        print(set(df["vannmiljo_code"]) - set(stn_df["vannmiljo_code"]))
+        for idx, name in enumerate(["parameter", "unit"])
+    )
 
-    # Check station ID have consistent names
-    print("\nThe following location IDs have inconsistent names within this template:")
-    site_ids = df["vannmiljo_code"].unique()
-    for site_id in site_ids:
-        true_name = stn_df.query("vannmiljo_code == @site_id")["station_name"].values
-        names = df.query("vannmiljo_code == @site_id")["station_name"].unique()
 
-        if len(names) > 1:
-            print("    ", f"{site_id} {true_name}", "  ==>  ", names)
+def join_par_unit(df, par_col="parameter", unit_col="unit"):
+    """Combine parameter and unit columns into categorical '<par>_<unit>' values.
+    Each distinct combination is only joined once.
 
-    # Check station names have consistent IDs
-    print("\nThe following location names have multiple IDs within this template:")
-    site_names = df["station_name"].unique()
-    for site_name in site_names:
-        true_id = stn_df.query("station_name == @site_name")["vannmiljo_code"].values
-        ids = df.query("station_name == @site_name")["vannmiljo_code"].unique()
+    Args:
+        df:       Dataframe. Water chemistry data in 'long' format
+        par_col:  Str. Name of parameter column
+        unit_col: Str. Name of unit column
 
-        if len(ids) > 1:
-            print("    ", f"{site_name} {true_id}", "  ==>  ", ids)
+    Returns:
+        Series.
+    """
+    codes, pairs = pd.MultiIndex.from_arrays([df[par_col], df[unit_col]]).factorize()
+    labels = [f"{par}_{unit}" for par, unit in pairs]
 
-    return None
+    return pd.Series(
+        _categorical_from_labels(labels, codes), index=df.index, name="par_unit"
+    )
 
 
-def check_quarter(df):
-    """Check all samples come from the same year quarter.
+def concat_long(dfs):
+    """Concatenate 'long' format dataframes (e.g. historic and new data), keeping
+    the columns in 'LONG_CAT_COLS' as categories. 'pd.concat' falls back to Python
+    strings when the categories of the inputs differ, so the categories are unified
+    first.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        dfs: List of dataframes
 
     Returns:
-        None. Problems identified are printed to output.
+        Dataframe with a new index.
     """
-    print("\nChecking sample dates:")
-    quarters = df["sample_date"].dt.quarter
-    if len(quarters.unique()) > 1:
-        print("    The file contains samples from several year quarters.")
-    else:
-        print("    Done.")
-
-    return None
-
-
-def check_no3_totn(df):
-    """Check nitrate < TOTN.
+    dfs = list(dfs)
+    for col in LONG_CAT_COLS:
+        if not all(col in df.columns for df in dfs):
+            continue
+        categories = union_categoricals(
+            [df[col].astype("category") for df in dfs], sort_categories=True
+        ).categories
+        dtype = pd.CategoricalDtype(categories)
+        dfs = [df.astype({col: dtype}) for df in dfs]
+
+    return pd.concat(dfs, axis="rows", ignore_index=True)
+
+
+def convert_historic_data(file_path, parquet_path=None):
+    """Convert the Excel file exported from Vannmiljø to a Parquet dataset, which
+    is much faster to read than Excel. Data for all activities are tidied and
+    stored, partitioned by activity ID and year, with stations, labs, parameters
+    and flags stored as categories. Any existing dataset at 'parquet_path' is
+    replaced.
 
     Args:
-        df: Dataframe of sumbitted water chemistry data
+        file_path:    Raw str. Path to Excel file exported from Vannmiljø
+        parquet_path: Raw str or None. Folder for the Parquet dataset. Default is
+                      the path to the Excel file, with the extension replaced by
+                      '.parquet'
 
     Returns:
-        None. Problems identified are printed to output.
+        Str. Path to the Parquet dataset.
     """
-    print("\nChecking NO3 and TOTN:")
-    mask_df = df[
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "depth1",
-            "depth2",
-            "NO3_µg/l",
-            "Tot-N_µg/l",
-        ]
-    ].copy()
+    if parquet_path is None:
+        parquet_path = os.path.splitext(file_path)[0] + ".parquet"
 
-    for col in ["NO3_µg/l", "Tot-N_µg/l"]:
-        mask_df[col] = mask_df[col].fillna(0)
-        mask_df[col] = pd.to_numeric(
-            mask_df[col].astype(str).str.strip("<").str.replace(",", ".")
-        )
-    mask = mask_df["NO3_µg/l"] > mask_df["Tot-N_µg/l"]
-    mask_df = mask_df[mask]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
 
-    if len(mask_df) > 0:
-        print("The following samples have nitrate greater than total nitrogen:")
-        print(mask_df)
-    else:
-        print("    Done.")
+        df = pd.read_excel(
+            file_path,
+            sheet_name="VannmiljoEksport",
+            usecols="A:J,R:T,V,X:Y,AA",
+            keep_default_na=False,
+        )
 
-    return None
+    # Tidy
+    df["par_unit"] = df["Parameter_id"] + "_" + df["Enhet"]
+    df["value"] = pd.to_numeric(
+        df["Verdi"].astype(str).str.replace(",", "."), errors="coerce"
+    )
 
+    for col in ["Ovre_dyp", "Nedre_dyp"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
 
-def check_ral_ilal_lal(df):
-    """Check RAl - ILAl = LAl.
+    df.rename(
+        {
+            "Vannlokalitet_kode": "vannmiljo_code",
+            "Oppdragstaker": "lab",
+            "Tid_provetak": "sample_date",
+            "Ovre_dyp": "depth1",
+            "Nedre_dyp": "depth2",
+            "Operator": "flag",
+            "Aktivitet_id": "activity",
+        },
+        inplace=True,
+        axis="columns",
+    )
 
-    Args:
-        df: Dataframe of sumbitted water chemistry data
+    # Parse dates
+    df["sample_date"] = pd.to_datetime(df["sample_date"], format="%Y-%m-%d %H:%M:%S")
+    df["year"] = df["sample_date"].dt.year
 
-    Returns:
-        None. Problems identified are printed to output.
-    """
-    print("\nChecking Al fractions:")
-    mask_df = df[
+    # Cols of interest
+    df = df[
         [
             "vannmiljo_code",
             "sample_date",
+            "lab",
             "depth1",
             "depth2",
-            "RAl_µg/l",
-            "ILAl_µg/l",
-            "LAl_µg/l",
+            "par_unit",
+            "flag",
+            "value",
+            "activity",
+            "year",
         ]
-    ].copy()
-    mask_df.dropna(subset="LAl_µg/l", inplace=True)
-
-    for col in ["RAl_µg/l", "ILAl_µg/l", "LAl_µg/l"]:
-        mask_df[col] = mask_df[col].fillna(0)
-        mask_df[col] = pd.to_numeric(
-            mask_df[col].astype(str).str.strip("<").str.replace(",", ".")
-        )
-    mask_df["LAl_Calc_µg/l"] = (mask_df["RAl_µg/l"] - mask_df["ILAl_µg/l"]).round(1)
-    mask_df["LAl_µg/l"] = mask_df["LAl_µg/l"].round(1)
-    mask = mask_df["LAl_Calc_µg/l"] != mask_df["LAl_µg/l"]
-    mask_df = mask_df[mask]
-
-    if len(mask_df) > 0:
-        print("The following samples have LAl != RAl - ILAl:")
-        print(mask_df)
-    else:
-        print("    Done.")
-
-    return None
-
-
-def convert_units_to_vannmiljo(df, par_df, lab):
-    """Convert to VM par names and units.
-
-    Args:
-        df:     Dataframe of sumbitted water chemistry data
-        par_df: Dataframe of reference parameters
-        lab:    Str. Name of lab submitting data
-
-    Returns:
-        Dataframe in converted units.
-    """
-    par_df["par_unit"] = (
-        par_df[f"{lab.lower()}_name"] + "_" + par_df[f"{lab.lower()}_unit"]
+    ]
+    df = df.astype(
+        {
+            "vannmiljo_code": "category",
+            "lab": "category",
+            "depth1": "float",
+            "depth2": "float",
+            "par_unit": "category",
+            "flag": "category",
+            "value": "float",
+            "activity": "str",
+        }
     )
-    par_df["vm_par_unit"] = par_df["vannmiljo_id"] + "_" + par_df["vannmiljo_unit"]
 
-    df = pd.merge(
-        df,
-        par_df[["par_unit", "vm_par_unit", f"{lab.lower()}_to_vm_conv_fac"]],
-        how="left",
-        on="par_unit",
+    # 'to_parquet' adds files to existing partitions, so start from scratch
+    if os.path.exists(parquet_path):
+        shutil.rmtree(parquet_path)
+    df.to_parquet(
+        parquet_path, engine="pyarrow", partition_cols=["activity", "year"], index=False
     )
 
-    df["value"] = df["value"] * df[f"{lab.lower()}_to_vm_conv_fac"]
+    return parquet_path
 
-    return df
 
+def read_historic_data(file_path, st_yr=2012, end_yr=2020, activity="KALK"):
+    """Read historic data exported from Vannmiljø. Stations, labs, parameters, units
+    and flags are returned as categories (see 'LONG_CAT_COLS'). The Vannmiljø
+    '<par>_<unit>' is also returned as 'par_unit', as used by earlier notebooks.
 
-def read_historic_data(file_path, st_yr=2012, end_yr=2020):
-    """Read historic data exported from Vannmiljø.
+    The first time this is called for an Excel file, the data are converted to a
+    Parquet dataset (see 'convert_historic_data'). Subsequent calls read only the
+    partitions for 'activity' and the years of interest from Parquet. The dataset
+    is rebuilt automatically if the Excel file is modified.
 
      Args:
-        file_path:  Raw str. Path to Excel template
+        file_path:  Raw str. Path to Excel file exported from Vannmiljø
+        st_yr:      Int. First year of interest
+        end_yr:     Int. Last year of interest
+        activity:   Str. Vannmiljø 'Aktivitet_id' for the monitoring project
 
     Returns:
         Dataframe.
     """
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-
-        df = pd.read_excel(
-            file_path,
-            sheet_name="VannmiljoEksport",
-            usecols="A:J,R:T,V,X:Y,AA",
-            keep_default_na=False,
-        )
-
-        # Get just the monitoring project of interest
-        df = df.query("Aktivitet_id == 'KALK'")
-
-        # Tidy
-        df["par_unit"] = df["Parameter_id"] + "_" + df["Enhet"]
-        df["value"] = pd.to_numeric(df["Verdi"].astype(str).str.replace(",", "."))
-
-        for col in ["Ovre_dyp", "Nedre_dyp"]:
-            df[col] = pd.to_numeric(df[col])
-
-        df.drop(
-            [
-                "Vannlokalitet",
-                "Type",
-                "Aktivitet_id",
-                "Aktivitet_navn",
-                "Oppdragsgiver",
-                "Parameter_navn",
-                "Parameter_id",
-                "Enhet",
-                "Verdi",
-            ],
-            inplace=True,
-            axis="columns",
-        )
+    parquet_path = os.path.splitext(file_path)[0] + ".parquet"
+    if (not os.path.exists(parquet_path)) or (
+        os.path.getmtime(parquet_path) < os.path.getmtime(file_path)
+    ):
+        convert_historic_data(file_path, parquet_path)
+
+    df = pd.read_parquet(
+        parquet_path,
+        engine="pyarrow",
+        filters=[
+            ("activity", "==", activity),
+            ("year", ">=", st_yr),
+            ("year", "<=", end_yr),
+        ],
+    )
 
-        df.rename(
-            {
-                "Vannlokalitet_kode": "vannmiljo_code",
-                "Oppdragstaker": "lab",
-                "Tid_provetak": "sample_date",
-                "Ovre_dyp": "depth1",
-                "Nedre_dyp": "depth2",
-                "Operator": "flag",
-            },
-            inplace=True,
-            axis="columns",
-        )
+    # Subset to date range
+    df = df.query(f"'{st_yr}-01-01' <= sample_date <= '{end_yr}-12-31'")
 
-        # Parse dates
-        df["sample_date"] = pd.to_datetime(
-            df["sample_date"], format="%Y-%m-%d %H:%M:%S"
-        )
+    # Tidy. Categories are kept, dropping those only used by other activities/years
+    df = df.fillna({"depth1": 0, "depth2": 0})
+    df["parameter"], df["unit"] = split_par_unit(df["par_unit"])
+    for col in ["vannmiljo_code", "lab", "par_unit", "flag"]:
+        df[col] = df[col].astype("category").cat.remove_unused_categories()
+    if df["flag"].isna().any():
+        if "" not in df["flag"].cat.categories:
+            df["flag"] = df["flag"].cat.add_categories([""])
+        df["flag"] = df["flag"].fillna("")
 
-        # Subset to date range
-        df = df.query(f"'{st_yr}-01-01' <= sample_date <= '{end_yr}-12-31'")
-
-        # Tidy
-        df["depth1"].fillna(0, inplace=True)
-        df["depth2"].fillna(0, inplace=True)
-        df["flag"].fillna("", inplace=True)
-
-        # Cols of interest
-        df = df[
-            [
-                "vannmiljo_code",
-                "sample_date",
-                "lab",
-                "depth1",
-                "depth2",
-                "par_unit",
-                "flag",
-                "value",
-            ]
+    # Cols of interest
+    df = df[
+        [
+            "vannmiljo_code",
+            "sample_date",
+            "lab",
+            "depth1",
+            "depth2",
+            "par_unit",
+            "parameter",
+            "unit",
+            "flag",
+            "value",
         ]
+    ]
 
-        assert pd.isna(df).sum().sum() == 0, "Dataframe contains missing values."
+    assert pd.isna(df).sum().sum() == 0, "Dataframe contains missing values."
 
-        df = df.astype(
-            {
-                "vannmiljo_code": "str",
-                "sample_date": "datetime64[ns]",
-                "lab": "str",
-                "depth1": "float",
-                "depth2": "float",
-                "par_unit": "str",
-                "flag": "str",
-                "value": "float",
-            }
-        )
+    df = df.astype(
+        {
+            "sample_date": "datetime64[ns]",
+            "depth1": "float",
+            "depth2": "float",
+            "value": "float",
+        }
+    )
 
     return df
 
 
 def handle_duplicates(df, dup_csv, action="drop"):
-    """ """
-    assert action in ("drop", "average"), "'action' must be either 'drop' or 'average'."
+    """Resolve records with the same station, date, depth and parameter, using the
+    same duplicate handling as the Streamlit app (see '../app/duplicates.py').
+    Duplicated records are written to 'dup_csv', with a column 'dup_group'
+    identifying records with the same key.
+
+    Args:
+        df:      Dataframe. Water chemistry data in 'long' format
+        dup_csv: Raw str. Path to CSV for duplicated records
+        action:  Str. One of duplicates.POLICIES. 'flood' requires a
+                 'resultatkommentar' column
 
+    Returns:
+        Dataframe.
+    """
     key_cols = [
         "vannmiljo_code",
         "sample_date",
         # "lab",
         "depth1",
         "depth2",
-        "par_unit",
+        "parameter",
+        "unit",
     ]
-    dup_df = df[
-        df.duplicated(
-            key_cols,
-            keep=False,
-        )
-    ].sort_values(key_cols)
-    dup_df.to_csv(dup_csv, index=False)
-
-    if action == "average":
-        df = (
-            df.groupby(key_cols)
-            .aggregate(
-                {
-                    "flag": "first",
-                    "value": "mean",
-                }
-            )
-            .reset_index()
-        )
-        past_action = "averaged"
-    else:
-        # Drop
-        df.drop_duplicates(subset=key_cols, keep=False, inplace=True)
-        past_action = "dropped"
+    df, dup_df = duplicates.resolve_duplicates(
+        df, key_cols, policy=action, dup_csv=dup_csv
+    )
 
+    past_action = {
+        "drop": "dropped",
+        "average": "averaged",
+        "first": "reduced to the first record in each group",
+        "last": "reduced to the last record in each group",
+        "flood": "dropped, except for ordinary samples duplicated by flood samples",
+    }[action]
     print(
         f"\nThere are {len(dup_df)} duplicated records (same station_code-date-depth-parameter, but different value).\n"
         f"These will be {past_action}.\n"
@@ -605,124 +590,787 @@ def handle_duplicates(df, dup_csv, action="drop"):
     return df
 
 
-def check_data_ranges(df):
+def check_data_ranges(df, return_report=False):
     """Takes a tidied dataframe and checks for values outside of the ranges specified in
         parameter_unit_mapping.xlsx. Assumes values should be in the range
 
         min < value < max
 
-        (i.e. not <=). The checks are split by 'parameter' and 'period'.
+        (i.e. not <=). The checks are split by 'parameter' and 'period'. Values
+        outside the range are dropped from the historic period and kept in the new
+        period.
 
     Args:
-        df: Dataframe. Containing water chemistry
+        df:            Dataframe. Containing water chemistry
+        return_report: Bool. Whether to also return a summary of the values outside
+                       the ranges
 
     Returns:
-        Dataframe with problem rows in historic time period removed.
+        Dataframe with problem rows in historic time period removed. If
+        'return_report' is True, a tuple of dataframes (df, range_df), where
+        'range_df' has one row for each period and parameter with values outside
+        the range, giving the limits, the range of the data and the number of
+        values below, above and dropped.
     """
     for col in ["parameter", "period", "value"]:
         assert col in df.columns, f"Dataframe must contain a column named {col}"
 
-    assert set(df["period"].unique()) == set(
+    periods = set(df["period"].unique())
+    assert periods.issubset(
         ["historic", "new"]
     ), "'period' must contain only 'historic' or 'new'."
 
-    # Get min and max values
-    par_df = get_par_unit_mappings()
-
-    for period in ["historic", "new"]:
-        print(f"\nChecking data ranges for the '{period}' period.")
-        for idx, row in par_df.iterrows():
-            par = row["vannmiljo_id"]
-            par_min = row["min"]
-            par_max = row["max"]
-            data_min = df.query("(period == @period) and (parameter == @par)")[
-                "value"
-            ].min()
-            data_max = df.query("(period == @period) and (parameter == @par)")[
-                "value"
-            ].max()
-
-            if data_min <= par_min:
-                print(
-                    f"    {par}: Minimum value of {data_min:.2f} is less than or equal to lower limit ({par_min:.2f})."
-                )
-
-            if data_max >= par_max:
-                print(
-                    f"    {par}: Maximum value of {data_max:.2f} is greater than or equal to upper limit ({par_max:.2f})."
-                )
+    # Get min and max values for each row. Parameters are looked up once per category
+    lookup = get_par_registry().vannmiljo
+    pars = df["parameter"].astype("category")
+    lim_idx = _lookup_positions(pars, lookup.index)
+
+    # Index -1 (parameters without limits) picks the trailing NaN, which never fails
+    lower = np.append(lookup.mins, np.nan)[lim_idx]
+    upper = np.append(lookup.maxs, np.nan)[lim_idx]
+    values = df["value"].to_numpy(dtype=float)
+    below = values <= lower
+    above = values >= upper
+    drop = (below | above) & (df["period"] == "historic").to_numpy()
+
+    range_df = (
+        pd.DataFrame(
+            {
+                "period": df["period"].array,
+                "parameter": pars.array,
+                "lower": lower,
+                "upper": upper,
+                "value": values,
+                "below": below,
+                "above": above,
+                "dropped": drop,
+            }
+        )
+        .groupby(["period", "parameter"], observed=True)
+        .agg(
+            lower=("lower", "first"),
+            upper=("upper", "first"),
+            data_min=("value", "min"),
+            data_max=("value", "max"),
+            n_below=("below", "sum"),
+            n_above=("above", "sum"),
+            n_dropped=("dropped", "sum"),
+        )
+        .query("(n_below > 0) or (n_above > 0)")
+        .reset_index()
+    )
 
     # Remove values outside of plausible ranges from historic dataset
-    print("\nDropping problem rows from historic data.")
-    for idx, row in par_df.iterrows():
-        par = row["vannmiljo_id"]
-        par_min = row["min"]
-        par_max = row["max"]
-
-        drop_df = df.query(
-            "(parameter == @par) and "
-            "(period == 'historic') and "
-            "((value <= @par_min) or (value >= @par_max))"
-        )
+    df = df[~drop]
 
-        if len(drop_df) > 0:
-            print(f"    Dropping rows for {par}.")
-            df.drop(drop_df.index, axis="rows", inplace=True)
+    if return_report:
+        return (df, range_df)
 
     return df
 
 
-def read_data_from_sqlite(lab, year, qtr, version):
-    """Convenience function for reading all water chemistry data (historic and new)
-        from the database.
+def get_dataset_name(lab, year, qtr, version):
+    """Get the name used for a quarterly dataset in folder names and the master
+    database.
 
     Args:
         lab:     Str. Name of lab
         year:    Int. Year of interest
-        qtr:     Int. In range [1, 4]. Quarter to read
-        version: Int. Version of file to read
+        qtr:     Int. In range [1, 4]. Quarter of interest
+        version: Int. Version of file
+
+    Returns:
+        Str. E.g. 'eurofins_2025_q3_v1'.
+    """
+    return f"{lab.lower()}_{year}_q{qtr}_v{version}"
+
+
+def connect_master_db(db_path=MASTER_DB):
+    """Connect to the master database, creating any missing tables. The database
+    holds the stations, parameters and historic data once. Data for each quarter
+    are added using 'append_quarter' and labelled by 'dataset' (historic data use
+    dataset = 'historic'). In 'water_chemistry', stations and parameters are
+    referenced by integer keys ('station_id' and 'parameter_id'), which keeps the
+    table and its primary key index compact.
+
+    Args:
+        db_path: Raw str. Path to master database
+
+    Returns:
+        sqlite3 connection.
+    """
+    eng = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    eng.execute("PRAGMA foreign_keys = ON")
+
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS stations "
+        "( "
+        "  station_id integer NOT NULL, "
+        "  fylke text NOT NULL, "
+        "  vassdrag text NOT NULL, "
+        "  station_name text NOT NULL, "
+        "  station_number text, "
+        "  vannmiljo_code text NOT NULL UNIQUE, "
+        "  vannmiljo_name text, "
+        "  utm_east real NOT NULL, "
+        "  utm_north real NOT NULL, "
+        "  utm_zone integer NOT NULL, "
+        "  lon real NOT NULL, "
+        "  lat real NOT NULL, "
+        "  liming_status text NOT NULL, "
+        "  comment text, "
+        "  PRIMARY KEY (station_id) "
+        ")"
+    )
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS parameters_units "
+        "( "
+        "  parameter_id integer NOT NULL, "
+        "  vannmiljo_name text NOT NULL UNIQUE, "
+        "  vannmiljo_id text NOT NULL UNIQUE, "
+        "  vannmiljo_unit text NOT NULL, "
+        "  vestfoldlab_name text NOT NULL UNIQUE, "
+        "  vestfoldlab_unit text NOT NULL, "
+        "  vestfoldlab_to_vm_conv_fac real NOT NULL, "
+        "  eurofins_name text NOT NULL UNIQUE, "
+        "  eurofins_unit text NOT NULL, "
+        "  eurofins_to_vm_conv_fac real NOT NULL, "
+        "  min real NOT NULL, "
+        "  max real NOT NULL, "
+        "  PRIMARY KEY (parameter_id) "
+        ")"
+    )
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS datasets "
+        "( "
+        "  dataset text NOT NULL, "
+        "  lab text, "
+        "  year integer, "
+        "  qtr integer, "
+        "  version integer, "
+        "  n_rows integer NOT NULL, "
+        "  loaded datetime NOT NULL, "
+        "  PRIMARY KEY (dataset) "
+        ")"
+    )
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS water_chemistry "
+        "( "
+        "  dataset text NOT NULL, "
+        "  station_id integer NOT NULL, "
+        "  sample_date datetime NOT NULL, "
+        "  lab text NOT NULL, "
+        "  depth1 real, "
+        "  depth2 real, "
+        "  parameter_id integer NOT NULL, "
+        "  flag text, "
+        "  value real NOT NULL, "
+        "  unit text NOT NULL, "
+        "  PRIMARY KEY (dataset, station_id, sample_date, depth1, depth2, parameter_id), "
+        "  CONSTRAINT dataset_fkey FOREIGN KEY (dataset) "
+        "      REFERENCES datasets (dataset) "
+        "      ON UPDATE NO ACTION ON DELETE NO ACTION, "
+        "  CONSTRAINT station_id_fkey FOREIGN KEY (station_id) "
+        "      REFERENCES stations (station_id) "
+        "      ON UPDATE NO ACTION ON DELETE NO ACTION, "
+        "  CONSTRAINT parameter_id_fkey FOREIGN KEY (parameter_id) "
+        "      REFERENCES parameters_units (parameter_id) "
+        "      ON UPDATE NO ACTION ON DELETE NO ACTION "
+        ")"
+    )
+
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS historic_stats "
+        "( "
+        "  station_id integer NOT NULL, "
+        "  par text NOT NULL, "
+        "  depth1 real, "
+        "  depth2 real, "
+        "  month integer NOT NULL, "
+        "  count integer NOT NULL, "
+        "  min real NOT NULL, "
+        "  q1 real NOT NULL, "
+        "  median real NOT NULL, "
+        "  q3 real NOT NULL, "
+        "  max real NOT NULL, "
+        "  freq_min integer NOT NULL, "
+        "  freq_median real NOT NULL, "
+        "  freq_max integer NOT NULL, "
+        "  PRIMARY KEY (station_id, par, depth1, depth2, month), "
+        "  CONSTRAINT station_id_fkey FOREIGN KEY (station_id) "
+        "      REFERENCES stations (station_id) "
+        "      ON UPDATE NO ACTION ON DELETE NO ACTION "
+        ")"
+    )
+    eng.execute(
+        "CREATE TABLE IF NOT EXISTS historic_sampling "
+        "( "
+        "  station_id integer NOT NULL, "
+        "  month integer NOT NULL, "
+        "  freq_min integer NOT NULL, "
+        "  freq_median real NOT NULL, "
+        "  freq_max integer NOT NULL, "
+        "  PRIMARY KEY (station_id, month), "
+        "  CONSTRAINT station_id_fkey FOREIGN KEY (station_id) "
+        "      REFERENCES stations (station_id) "
+        "      ON UPDATE NO ACTION ON DELETE NO ACTION "
+        ")"
+    )
+
+    return eng
+
+
+def _create_wc_indexes(eng):
+    """Create secondary indexes on 'water_chemistry' in the master database."""
+    for name, cols in WC_INDEXES.items():
+        eng.execute(f"CREATE INDEX IF NOT EXISTS {name} ON water_chemistry ({cols})")
+
+
+def _column_values(ser):
+    """Convert a column to a list of Python values that can be passed to sqlite3.
+    Non-numeric columns are dictionary-encoded first, so that each distinct value
+    (e.g. a date or station code) is only converted once.
+    """
+    if pd.api.types.is_bool_dtype(ser) or pd.api.types.is_numeric_dtype(ser):
+        # NaN is stored as NULL by SQLite
+        return ser.to_numpy().tolist()
+
+    codes, uniques = pd.factorize(ser)
+    if isinstance(uniques, pd.DatetimeIndex):
+        uniques = uniques.strftime("%Y-%m-%d %H:%M:%S")
+    uniques = np.append(np.asarray(uniques, dtype=object), None)
+
+    # Missing values have code -1, which picks the trailing None
+    return uniques[codes].tolist()
+
+
+def bulk_insert(eng, table, df):
+    """Insert all rows in 'df' into an existing table using a single
+    'executemany'. Rows are streamed from column arrays rather than built into
+    multi-row INSERT statements, which is about 1.5 times faster than
+    'df.to_sql(method="multi")' for 'water_chemistry'. Unlike 'df.to_sql', this does
+    not commit, so it can be used inside a transaction.
+
+    Args:
+        eng:   sqlite3 connection
+        table: Str. Name of table. Columns in 'df' must exist in 'table'
+        df:    Dataframe. Rows to insert
+
+    Returns:
+        None.
+    """
+    cols = ", ".join(df.columns)
+    params = ", ".join(["?"] * len(df.columns))
+    values = [_column_values(df[col]) for col in df.columns]
+    eng.executemany(
+        f"INSERT INTO {table} ({cols}) VALUES ({params})",
+        zip(*values),
+    )
+
+    return None
+
+
+def _get_id_lookup(eng, table, id_col, code_col):
+    """Series mapping codes to integer keys for 'table' in the master database."""
+    lookup = pd.read_sql(f"SELECT {id_col}, {code_col} FROM {table}", eng)
+
+    return lookup.set_index(code_col)[id_col]
+
+
+def _encode_ids(values, lookup, name):
+    """Array of integer keys for 'values', raising ValueError for unknown codes.
+    Categorical values are encoded via their categories.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+        ids = _encode_ids(values.cat.categories, lookup, name)
+
+        return ids[values.cat.codes.to_numpy()]
+
+    idx = lookup.index.get_indexer(values)
+    if (idx == -1).any():
+        unknown = sorted(pd.unique(np.asarray(values)[idx == -1]).astype(str))
+        raise ValueError(f"Unknown {name} in master database: {unknown}.")
+
+    return lookup.to_numpy()[idx]
+
+
+def _assign_ids(new_codes, lookup):
+    """Integer keys for 'new_codes', reusing those in 'lookup' where possible so
+    that records already in the database keep pointing to the same rows.
+    """
+    ids = pd.Series(new_codes).map(lookup)
+    n_new = ids.isna().sum()
+    start = 1 if len(lookup) == 0 else lookup.max() + 1
+    ids[ids.isna()] = np.arange(start, start + n_new)
+
+    return ids.astype(int).to_numpy()
+
+
+def _write_dataset(eng, dataset, df, lab=None, year=None, qtr=None, version=None):
+    """Replace all water chemistry records for 'dataset' in the master database with
+    those in 'df'. Must be called within a transaction.
+    """
+    eng.execute("DELETE FROM water_chemistry WHERE dataset = ?", (dataset,))
+    eng.execute("DELETE FROM datasets WHERE dataset = ?", (dataset,))
+    eng.execute(
+        "INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?, datetime('now'))",
+        (dataset, lab, year, qtr, version, len(df)),
+    )
+
+    stn_ids = _get_id_lookup(eng, "stations", "station_id", "vannmiljo_code")
+    par_ids = _get_id_lookup(eng, "parameters_units", "parameter_id", "vannmiljo_id")
+    wc_df = pd.DataFrame(
+        {
+            "dataset": dataset,
+            "station_id": _encode_ids(df["vannmiljo_code"], stn_ids, "stations"),
+            "sample_date": df["sample_date"].to_numpy(),
+            "lab": df["lab"].array,
+            "depth1": df["depth1"].to_numpy(),
+            "depth2": df["depth2"].to_numpy(),
+            "parameter_id": _encode_ids(df["parameter"], par_ids, "parameters"),
+            "flag": df["flag"].array,
+            "value": df["value"].to_numpy(),
+            "unit": df["unit"].array,
+        }
+    )
+
+    # Inserting in primary key order keeps B-tree page splits to a minimum
+    wc_df.sort_values(
+        ["station_id", "sample_date", "depth1", "depth2", "parameter_id"],
+        inplace=True,
+    )
+    bulk_insert(eng, "water_chemistry", wc_df)
+
+
+def load_historic_to_master(his_df, stn_df, par_df, db_path=MASTER_DB):
+    """Load (or replace) the stations, parameters and historic baseline in the master
+    database. Only needs running when a new export from Vannmiljø is used.
+
+    Everything is loaded in a single transaction. Secondary indexes on
+    'water_chemistry' are dropped first and rebuilt once the data are in place,
+    which is much faster than updating them row by row. Summary statistics for each
+    station, parameter, depth and month are also stored in 'historic_stats' (see
+    'read_historic_stats'), and sampling frequencies for each station and month in
+    'historic_sampling' (see 'read_historic_sampling').
+
+    Args:
+        his_df:  Dataframe. Tidied historic data in 'long' format, with columns
+                 'parameter' and 'unit' (see '01_data_processing')
+        stn_df:  Dataframe. Station details, including 'lat' and 'lon'
+        par_df:  Dataframe. Parameter mappings (see 'get_par_unit_mappings')
+        db_path: Raw str. Path to master database
+
+    Returns:
+        None.
+    """
+    eng = connect_master_db(db_path)
+    with eng:
+        # Quarterly data reference the stations and parameters, so check these
+        # at the end of the transaction
+        eng.execute("BEGIN")
+        eng.execute("PRAGMA defer_foreign_keys = ON")
+
+        stn_ids = _get_id_lookup(eng, "stations", "station_id", "vannmiljo_code")
+        par_ids = _get_id_lookup(
+            eng, "parameters_units", "parameter_id", "vannmiljo_id"
+        )
+        stn_df = stn_df.copy()
+        par_df = par_df.copy()
+        stn_df.insert(0, "station_id", _assign_ids(stn_df["vannmiljo_code"], stn_ids))
+        par_df.insert(0, "parameter_id", _assign_ids(par_df["vannmiljo_id"], par_ids))
+        eng.execute("DELETE FROM stations")
+        eng.execute("DELETE FROM parameters_units")
+        bulk_insert(eng, "stations", stn_df)
+        bulk_insert(eng, "parameters_units", par_df)
+
+        # The indexes are only dropped now, because the foreign key checks when
+        # replacing stations and parameters use them
+        for name in WC_INDEXES:
+            eng.execute(f"DROP INDEX IF EXISTS {name}")
+        _write_dataset(eng, "historic", his_df)
+        _create_wc_indexes(eng)
+
+        # Summaries used for checking new data without reading the historic series
+        his_df = his_df.assign(par=join_par_unit(his_df))
+        stn_ids = _get_id_lookup(eng, "stations", "station_id", "vannmiljo_code")
+        for table, sum_df in [
+            ("historic_stats", historic.get_historic_stats(his_df)),
+            ("historic_sampling", historic.get_sampling_stats(his_df)),
+        ]:
+            sum_df.insert(
+                0,
+                "station_id",
+                _encode_ids(sum_df.pop("vannmiljo_code"), stn_ids, "stations"),
+            )
+            eng.execute(f"DELETE FROM {table}")
+            bulk_insert(eng, table, sum_df)
+    eng.close()
+
+    return None
+
+
+def export_historic_baseline(out_dir=HISTORIC_BASELINE, db_path=MASTER_DB):
+    """Save a compact summary of the historic data in the master database, which is
+    used by the Streamlit app to compare uploaded data with historic values. Re-run
+    after 'load_historic_to_master' and commit the output.
+
+    Args:
+        out_dir: Raw str. Folder for output
+        db_path: Raw str. Path to master database
+
+    Returns:
+        historic.Baseline.
+    """
+    baseline = historic.Baseline(
+        read_historic_stats(db_path=db_path), read_historic_sampling(db_path=db_path)
+    )
+    historic.save_baseline(baseline, out_dir)
+
+    return baseline
+
+
+def _read_historic_table(table, cols, stations, month, db_path):
+    """Read a table of historic summaries from the master database, with stations
+    identified by their Vannmiljø code.
+    """
+    where = []
+    params = []
+    if stations is not None:
+        where.append(f"s.vannmiljo_code IN ({', '.join(['?'] * len(stations))})")
+        params += list(stations)
+    if month is not None:
+        where.append("h.month = ?")
+        params.append(month)
+    where = "" if len(where) == 0 else "WHERE " + " AND ".join(where)
+
+    eng = sqlite3.connect(db_path)
+    sum_df = pd.read_sql(
+        f"SELECT s.vannmiljo_code, {', '.join('h.' + col for col in cols)} "
+        f"FROM {table} AS h "
+        f"JOIN stations AS s ON h.station_id = s.station_id {where}",
+        eng,
+        params=params,
+    )
+    eng.close()
+    assert (len(sum_df) > 0) or (len(params) > 0), (
+        f"'{table}' is empty. Load the historic data using "
+        "'load_historic_to_master'."
+    )
+
+    return sum_df
+
+
+def read_historic_stats(stations=None, month=None, db_path=MASTER_DB):
+    """Read summary statistics for the historic data from the master database (see
+    'historic.get_historic_stats' for details).
+
+    Args:
+        stations: List of str or None. Vannmiljø codes for stations to return
+        month:    Int or None. In range [0, 12]. Month to return, where 0 returns
+                  statistics for all months combined
+        db_path:  Raw str. Path to master database
+
+    Returns:
+        Dataframe.
+    """
+    cols = ["par", "depth1", "depth2", "month"] + historic.STATS_COLS
+
+    return _read_historic_table("historic_stats", cols, stations, month, db_path)
+
+
+def read_historic_sampling(stations=None, month=None, db_path=MASTER_DB):
+    """Read the minimum, median and maximum number of samples per month at each
+    station in the historic data from the master database (see
+    'historic.get_sampling_stats' for details).
+
+    Args:
+        stations: List of str or None. Vannmiljø codes for stations to return
+        month:    Int or None. In range [1, 12]. Month to return
+        db_path:  Raw str. Path to master database
+
+    Returns:
+        Dataframe.
+    """
+    cols = ["month", "freq_min", "freq_median", "freq_max"]
+
+    return _read_historic_table("historic_sampling", cols, stations, month, db_path)
+
+
+def append_quarter(new_df, lab, year, qtr, version, db_path=MASTER_DB):
+    """Add new data for one quarter to the master database, together with a view
+    named 'water_chemistry_<dataset>' combining them with the historic baseline.
+    The view has the same columns as the 'water_chemistry' table in the quarterly
+    databases created by earlier versions of '01_data_processing'. Re-running for
+    the same quarter and version replaces the previous records.
+
+    Args:
+        new_df:  Dataframe. Tidied new data in 'long' format, with columns
+                 'parameter' and 'unit' (see '01_data_processing')
+        lab:     Str. Name of lab
+        year:    Int. Year of interest
+        qtr:     Int. In range [1, 4]. Quarter of interest
+        version: Int. Version of file
+        db_path: Raw str. Path to master database
+
+    Returns:
+        Str. Name of the view for this quarter.
+    """
+    if "period" in new_df.columns:
+        assert (new_df["period"] == "new").all(), "'new_df' must only contain new data."
+
+    dataset = get_dataset_name(lab, year, qtr, version)
+    view = f"water_chemistry_{dataset}"
+    eng = connect_master_db(db_path)
+    with eng:
+        _write_dataset(eng, dataset, new_df, lab, year, qtr, version)
+        _create_wc_indexes(eng)
+        eng.execute(f"DROP VIEW IF EXISTS {view}")
+        eng.execute(
+            f"CREATE VIEW {view} AS "
+            "SELECT s.vannmiljo_code, w.sample_date, w.lab, "
+            "  CASE WHEN w.dataset = 'historic' THEN 'historic' ELSE 'new' END AS period, "
+            "  w.depth1, w.depth2, p.vannmiljo_id AS parameter, w.flag, w.value, w.unit "
+            "FROM water_chemistry AS w "
+            "JOIN stations AS s ON w.station_id = s.station_id "
+            "JOIN parameters_units AS p ON w.parameter_id = p.parameter_id "
+            f"WHERE w.dataset IN ('historic', '{dataset}')"
+        )
+    eng.close()
+
+    return view
+
+
+def read_data_from_sqlite(
+    lab,
+    year,
+    qtr,
+    version,
+    par_units=None,
+    stations=None,
+    period=None,
+    st_dt=None,
+    end_dt=None,
+):
+    """Convenience function for reading water chemistry data (historic and new)
+        from the database. Data are read from the master database if the quarter has
+        been added using 'append_quarter'; otherwise from the quarterly database in
+        the 'output' folder.
+
+        By default, everything is read. The optional filters are applied in the
+        database, so only the records of interest are loaded and reshaped.
+
+    Args:
+        lab:       Str. Name of lab
+        year:      Int. Year of interest
+        qtr:       Int. In range [1, 4]. Quarter to read
+        version:   Int. Version of file to read
+        par_units: List of str or None. Columns to return, in the same format as
+                   the wide dataframe e.g. ['CA_mg/l', 'PH_<ubenevnt>']
+        stations:  List of str or None. Vannmiljø codes for stations to return
+        period:    Str or None. One of ['historic', 'new']
+        st_dt:     Str, datetime or None. Earliest sample date (inclusive)
+        end_dt:    Str, datetime or None. Latest sample date (inclusive). If no time
+                   is given, the whole day is included
 
     Returns:
         Tuple of dataframes (stn_df, wc_df)
     """
+    if period is not None:
+        assert period in ("historic", "new"), "'period' must be 'historic' or 'new'."
+
     # Connect to database
-    fold_path = f"../../output/{lab.lower()}_{year}_q{qtr}_v{version}"
-    db_path = os.path.join(fold_path, "kalk_data.db")
-    eng = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    dataset = get_dataset_name(lab, year, qtr, version)
+    wc_table = f"water_chemistry_{dataset}"
+    eng = None
+    if os.path.exists(MASTER_DB):
+        eng = sqlite3.connect(MASTER_DB, detect_types=sqlite3.PARSE_DECLTYPES)
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?"
+        if eng.execute(sql, (wc_table,)).fetchone() is None:
+            eng.close()
+            eng = None
+    if eng is None:
+        fold_path = f"../../output/{dataset}"
+        db_path = os.path.join(fold_path, "kalk_data.db")
+        eng = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        wc_table = "water_chemistry"
+
+    # Build filters
+    where = []
+    params = []
+    if par_units is not None:
+        # Filtering on 'parameter' alone lets SQLite use the indexes
+        pars = sorted({par_unit.split("_", 1)[0] for par_unit in par_units})
+        where.append(f"parameter IN ({', '.join(['?'] * len(pars))})")
+        params += pars
+        where.append(
+            f"parameter || '_' || unit IN ({', '.join(['?'] * len(par_units))})"
+        )
+        params += list(par_units)
+    if stations is not None:
+        where.append(f"vannmiljo_code IN ({', '.join(['?'] * len(stations))})")
+        params += list(stations)
+    if period is not None:
+        where.append("period = ?")
+        params.append(period)
+    if st_dt is not None:
+        where.append("sample_date >= ?")
+        params.append(pd.Timestamp(st_dt).strftime("%Y-%m-%d %H:%M:%S"))
+    if end_dt is not None:
+        end_dt = pd.Timestamp(end_dt)
+        if end_dt == end_dt.normalize():
+            where.append("sample_date < ?")
+            end_dt = end_dt + pd.Timedelta(days=1)
+        else:
+            where.append("sample_date <= ?")
+        params.append(end_dt.strftime("%Y-%m-%d %H:%M:%S"))
+    where = "" if len(where) == 0 else "WHERE " + " AND ".join(where)
 
     # Read tables
     stn_df = pd.read_sql("SELECT * FROM stations", eng)
-    par_df = pd.read_sql("SELECT * FROM parameters_units", eng)
-    wc_df = pd.read_sql("SELECT * FROM water_chemistry", eng)
+    stn_df.drop(columns="station_id", errors="ignore", inplace=True)
+    if stations is not None:
+        stn_df = stn_df[stn_df["vannmiljo_code"].isin(stations)].reset_index(drop=True)
+    key_cols = ["vannmiljo_code", "sample_date", "lab", "period", "depth1", "depth2"]
+    wc_df = pd.read_sql(
+        f"SELECT {', '.join(key_cols)}, parameter || '_' || unit AS par_unit, value "
+        f"FROM {wc_table} {where}",
+        eng,
+        params=params,
+    )
+    eng.close()
     wc_df["sample_date"] = pd.to_datetime(
         wc_df["sample_date"], format="%Y-%m-%d %H:%M:%S"
     )
 
-    # Combine pars and units into one column
-    wc_df["par_unit"] = wc_df["parameter"] + "_" + wc_df["unit"]
-    wc_df.drop(["parameter", "flag", "unit"], axis="columns", inplace=True)
-
-    # Convert to wide format
-    df = wc_df.set_index(
-        [
-            "vannmiljo_code",
-            "sample_date",
-            "lab",
-            "period",
-            "depth1",
-            "depth2",
-            "par_unit",
-        ]
-    ).unstack("par_unit")
+    # Convert to wide format. Each (sample, par_unit) pair is unique in the
+    # database, so values can be scattered directly into a preallocated array
+    grouped = wc_df.groupby(key_cols, sort=True, dropna=False)
+    row_idx = grouped.ngroup().to_numpy()
+    col_idx, par_unit_cols = pd.factorize(wc_df["par_unit"], sort=True)
+    values = np.full((grouped.ngroups, len(par_unit_cols)), np.nan)
+    values[row_idx, col_idx] = wc_df["value"].to_numpy()
+    first = np.unique(row_idx, return_index=True)[1]
 
     # Tidy
-    df.columns = df.columns.get_level_values(1)
-    df.reset_index(inplace=True)
+    df = wc_df[key_cols].iloc[first].reset_index(drop=True)
+    df = pd.concat([df, pd.DataFrame(values, columns=par_unit_cols)], axis="columns")
     df.columns.name = ""
 
     return (stn_df, df)
 
 
+def annotate_outliers(
+    xl_path,
+    out_xl_path,
+    out_df,
+    lab,
+    sheet_name="results",
+    col_name="TimeSeriesOutlier",
+):
+    """Copy a lab template, highlighting outlying values and adding a column with 1
+    for samples containing at least one outlier and 0 otherwise.
+
+    Rows are located using the station code and sample date, and columns using the
+    parameter and unit headers, so the layout of the template does not need to be
+    known in advance. The new column is added after the last column in the sheet,
+    unless a column named 'col_name' already exists.
+
+    Args:
+        xl_path:     Raw str. Path to original template
+        out_xl_path: Raw str. Path for annotated copy
+        out_df:      Dataframe. Outliers, with columns 'vannmiljo_code',
+                     'sample_date' and 'par' (Vannmiljø 'par_unit')
+        lab:         Str. Name of lab. One of ['VestfoldLAB', 'Eurofins']
+        sheet_name:  Str. Name of sheet with data
+        col_name:    Str. Header for the new column
+
+    Returns:
+        None.
+    """
+    outlier_colour = PatternFill(
+        start_color="00FFFF00", end_color="00FFFF00", fill_type="solid"
+    )
+    header_colour = PatternFill(
+        start_color="FF00B0F0", end_color="FF00B0F0", fill_type="solid"
+    )
+    first_row = 4
+
+    wb = load_workbook(xl_path)
+    ws = wb[sheet_name]
+
+    # Map headers => column number. Sample details are labelled in row 3, while
+    # parameters use names in row 2 and units in row 3
+    pars = [cell.value for cell in ws[2]]
+    units = [cell.value for cell in ws[3]]
+    header_cols = {}
+    for col_idx, (par, unit) in enumerate(zip(pars, units), start=1):
+        header_cols.setdefault(unit, col_idx)
+        header_cols.setdefault(f"{par}_{unit}", col_idx)
+    stn_col = header_cols["Lokalitets-ID"]
+    date_col = header_cols["Prøvedato"]
+    if col_name in header_cols:
+        flag_col = header_cols[col_name]
+    else:
+        flag_col = ws.max_column + 1
+
+    # Map Vannmiljø 'par_unit' => column number
+    lookup = get_par_registry().labs[lab]
+    par_cols = {
+        vm_par_unit: header_cols[lab_par_unit]
+        for vm_par_unit, lab_par_unit in zip(lookup.vm_par_units, lookup.index)
+        if lab_par_unit in header_cols
+    }
+
+    # Map (station, date) => row number
+    min_col = min(stn_col, date_col)
+    row_idx = {}
+    for row_num, row in enumerate(
+        ws.iter_rows(
+            min_row=first_row,
+            min_col=min_col,
+            max_col=max(stn_col, date_col),
+            values_only=True,
+        ),
+        start=first_row,
+    ):
+        stn_id = row[stn_col - min_col]
+        if stn_id is None:
+            continue
+        key = (str(stn_id), pd.Timestamp(row[date_col - min_col]))
+        row_idx[key] = None if key in row_idx else row_num
+
+    # Highlight outliers
+    outlier_rows = set()
+    for stn_id, date, par in zip(
+        out_df["vannmiljo_code"], out_df["sample_date"], out_df["par"]
+    ):
+        row_num = row_idx.get((str(stn_id), pd.Timestamp(date)), -1)
+        assert row_num != -1, f"No row found in spreadsheet for {stn_id} on {date}."
+        assert (
+            row_num is not None
+        ), f"Multiple rows found in spreadsheet for {stn_id} on {date}."
+        ws.cell(row=row_num, column=par_cols[par]).fill = outlier_colour
+        outlier_rows.add(row_num)
+
+    # Add new column
+    col_letter = ws.cell(row=3, column=flag_col).column_letter
+    ws.column_dimensions[col_letter].width = 25
+    header_cell = ws.cell(row=3, column=flag_col, value=col_name)
+    header_cell.font = Font(bold=True)
+    header_cell.alignment = Alignment(horizontal="center")
+    for row_num in range(1, first_row):
+        ws.cell(row=row_num, column=flag_col).fill = header_colour
+    for row_num in range(first_row, ws.max_row + 1):
+        ws.cell(row=row_num, column=flag_col, value=int(row_num in outlier_rows))
+
+    # Apply filter to all cols and save
+    ws.auto_filter.ref = ws.dimensions
+    wb.save(out_xl_path)
+
+    return None
+
+
 def isolation_forest(df, par_cols, contamination=0.01, random_state=42):
     """Apply sklearn's Isolation Forest algorithm.
 
@@ -742,4 +1390,202 @@ def isolation_forest(df, par_cols, contamination=0.01, random_state=42):
     df["pred"] = iso.fit_predict(df[par_cols])
     df["pred"] = df["pred"].replace({1: "inlier", -1: "outlier"})
 
-    return df
\ No newline at end of file
+    return df
+
+
+def _fit_isolation_forest(values, contamination, random_state):
+    """Fit an Isolation Forest to an array of training data. Runs in worker
+    processes for 'fit_isolation_forests'.
+    """
+    iso = IsolationForest(contamination=contamination, random_state=random_state)
+    iso.fit(values)
+
+    return iso
+
+
+def _get_isoforest_fingerprint(train_df, contamination, random_state):
+    """Hash identifying the training data and settings for an Isolation Forest."""
+    sha = hashlib.sha256()
+    sha.update(pd.util.hash_pandas_object(train_df, index=False).to_numpy().tobytes())
+    sha.update(
+        repr(
+            (list(train_df.columns), contamination, random_state, sklearn.__version__)
+        ).encode()
+    )
+
+    return sha.hexdigest()[:16]
+
+
+def fit_isolation_forests(
+    his_df,
+    par_sets,
+    contamination=0.01,
+    random_state=42,
+    n_jobs=None,
+    model_dir=ISOFOREST_MODELS,
+):
+    """Fit an Isolation Forest to the historic data for each set of parameters. Models
+    are saved in 'model_dir', named by a fingerprint of the training data and
+    settings, so they are only fitted again when the historic data change. Models
+    that need fitting are fitted in parallel.
+
+    Missing values are handled separately for each set: a model is trained on all
+    samples with values for its own parameters, regardless of other columns.
+
+    Args:
+        his_df:        Dataframe. Historic samples in 'wide' format (see
+                       'read_data_from_sqlite')
+        par_sets:      Dict. Maps a name for each set to a list of numeric columns
+        contamination: Float. Proportion of historic samples expected to be
+                       'outliers'
+        random_state:  Int. Initialisation state for random forest (for
+                       repeatability)
+        n_jobs:        Int or None. Number of worker processes. Default is the
+                       number of CPUs
+        model_dir:     Raw str. Folder for saved models
+
+    Returns:
+        Dict mapping the names in 'par_sets' to IsoForestModel.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+
+    models = {}
+    to_fit = {}
+    for name, par_cols in par_sets.items():
+        train_df = his_df[par_cols].dropna()
+        fingerprint = _get_isoforest_fingerprint(train_df, contamination, random_state)
+        model_path = os.path.join(model_dir, f"{name}_{fingerprint}.joblib")
+        if os.path.exists(model_path):
+            iso = joblib.load(model_path)
+            models[name] = IsoForestModel(name, list(par_cols), fingerprint, iso)
+        else:
+            to_fit[name] = (list(par_cols), fingerprint, model_path, train_df)
+
+    if len(to_fit) > 0:
+        args = [
+            (train_df.to_numpy(dtype=float), contamination, random_state)
+            for par_cols, fingerprint, model_path, train_df in to_fit.values()
+        ]
+        if len(to_fit) == 1 or n_jobs == 1:
+            fitted = [_fit_isolation_forest(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                fitted = list(executor.map(_fit_isolation_forest, *zip(*args)))
+
+        for (name, (par_cols, fingerprint, model_path, _)), iso in zip(
+            to_fit.items(), fitted
+        ):
+            joblib.dump(iso, model_path)
+            models[name] = IsoForestModel(name, par_cols, fingerprint, iso)
+
+    return {name: models[name] for name in par_sets}
+
+
+def score_isolation_forest(df, model):
+    """Classify samples using an Isolation Forest fitted by 'fit_isolation_forests'.
+    Only samples with values for all of the model's parameters are scored.
+
+    Args:
+        df:    Dataframe. Samples to be classified, e.g. the new data for a quarter
+        model: IsoForestModel
+
+    Returns:
+        Copy of the rows of df with values for the model's parameters, with a new
+        column 'pred' ('inlier' or 'outlier').
+    """
+    df = df.dropna(subset=model.par_cols).copy()
+    if len(df) == 0:
+        df["pred"] = pd.Series(dtype=object)
+        return df
+
+    pred = model.model.predict(df[model.par_cols].to_numpy(dtype=float))
+    df["pred"] = np.where(pred == -1, "outlier", "inlier")
+
+    return df
+
+
+def thin_by_rank(df, group_cols, max_points, value_col="value", keep=None):
+    """Reduce the number of rows in each group of 'df' to at most 'max_points', for
+    plotting. Rows are chosen at evenly spaced ranks of 'value_col' within each
+    group, so the selected values are a quantile summary of the group (including
+    the minimum and maximum) and each is still a real record for tooltips.
+
+    Args:
+        df:         Dataframe
+        group_cols: List of str. Columns defining groups (e.g. parameter and period)
+        max_points: Int. Maximum number of rows per group. Must be at least 2
+        value_col:  Str. Column used to rank rows
+        keep:       Array of bool or None. Rows that are always kept (e.g. the new
+                    data), and not counted towards 'max_points'
+
+    Returns:
+        Dataframe. Subset of 'df', in the original order.
+    """
+    assert max_points >= 2, "'max_points' must be at least 2."
+
+    keep = np.zeros(len(df), dtype=bool) if keep is None else np.asarray(keep)
+    pos = np.flatnonzero(~keep)
+    sub_df = df.iloc[pos]
+    group_idx = (
+        sub_df.groupby(group_cols, sort=False, observed=True, dropna=False)
+        .ngroup()
+        .to_numpy()
+    )
+    order = np.lexsort((sub_df[value_col].to_numpy(dtype=float), group_idx))
+    counts = np.bincount(group_idx, minlength=1)
+    starts = np.cumsum(counts) - counts
+
+    # Groups small enough are kept whole. Larger groups keep evenly spaced ranks
+    selected = keep.copy()
+    small = counts[group_idx] <= max_points
+    selected[pos[small]] = True
+    large = np.flatnonzero(counts > max_points)
+    ranks = np.rint(
+        np.arange(max_points) * (counts[large, None] - 1) / (max_points - 1)
+    ).astype(int)
+    selected[pos[order[(starts[large, None] + ranks).ravel()]]] = True
+
+    return df[selected]
+
+
+def export_plot_data(df, key_col, out_dir, cols=None):
+    """Write the rows of 'df' for each value of 'key_col' (e.g. each parameter or data
+    series) to a separate JSON file in 'out_dir', for web pages that only download
+    the data for the option chosen. 'index.json' lists the options in sorted order,
+    as objects with keys 'label' and 'file'.
+
+    File names are derived from a hash of the label, so they are valid on any file
+    system and stable between quarters.
+
+    Args:
+        df:      Dataframe. Data to plot
+        key_col: Str. Column defining the options in the web page
+        out_dir: Raw str. Folder for output. Existing JSON files are removed
+        cols:    List of str or None. Columns to include. Default is all columns
+
+    Returns:
+        Dataframe with columns 'label', 'file' and 'count' (number of records).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for fname in os.listdir(out_dir):
+        if fname.endswith(".json"):
+            os.remove(os.path.join(out_dir, fname))
+
+    cols = list(df.columns) if cols is None else cols
+    index = []
+    for label, grp_df in df.groupby(key_col, sort=True, observed=True):
+        label = str(label)
+        fname = hashlib.sha1(label.encode("utf-8")).hexdigest()[:16] + ".json"
+        grp_df[cols].to_json(
+            os.path.join(out_dir, fname),
+            orient="records",
+            date_format="iso",
+            force_ascii=False,
+        )
+        index.append({"label": label, "file": fname, "count": len(grp_df)})
+    index_df = pd.DataFrame(index, columns=["label", "file", "count"])
+    index_df[["label", "file"]].to_json(
+        os.path.join(out_dir, "index.json"), orient="records", force_ascii=False
+    )
+
+    return index_df